@@ -1,25 +1,56 @@
-from flask import Flask, request, render_template, jsonify, url_for
+from flask import Flask, Response, abort, request, render_template, jsonify, send_from_directory, url_for
+
+import base64
+
+import os
 
 import json
 
-import hashlib
+import threading
 
 from datetime import datetime
 
-from crowding import _live_crowding, live_crowding, best_station_match
+from crowding import BudgetedCrowding, CrowdingRefresher, Deadline, best_station_match
+
+from occupancy import line_color, live_overlay, live_profile
 
-from occupancy import generate_live_overlay
+from overlay_cache import OverlayCache
+
+from routes import line_stations, route_index
+
+from timings import Timings, stage
 
 app = Flask(__name__)
 
+# per-request stage timings are logged at INFO, one JSON object per line
+app.logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# Index every station's routes in the background; a request for a station not
+# read yet loads just that station's file.
+threading.Thread(target=route_index("data", "Piccadilly").preload, daemon=True).start()
+
+# Keep a line-wide live crowding snapshot warm so requests never wait on TfL.
+# CROWDING_REFRESH_INTERVAL=0 turns it off (e.g. when running without an API key).
+_refresh_interval = float(os.getenv("CROWDING_REFRESH_INTERVAL", "300"))
+if _refresh_interval > 0:
+    CrowdingRefresher(line_stations("Piccadilly"), interval=_refresh_interval).start()
+
+# Rendered overlays by content key, served from memory by /overlay/<key>.png.
+# OVERLAY_CACHE_DIR adds a bounded disk tier shared by workers and restarts.
+OVERLAY_CACHE = OverlayCache(os.getenv("OVERLAY_CACHE_DIR"), max_bytes=64 * 1024 * 1024, max_files=2000)
+
+# content-addressed URLs never change meaning
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# time a request may spend waiting on TfL; inputs not fetched by then fall
+# back to their last known value (or the baseline) and are reported as degraded
+CROWDING_DEADLINE = float(os.getenv("CROWDING_DEADLINE_MS", "800")) / 1000
+
+
 def current_time_str():
     """Return current local time as 'HH:MM' string (24-hour clock)."""
     return datetime.now().strftime("%H:%M")
 
-def md5_of_string(s):
-    """Return the hex MD5 digest of a string."""
-    return hashlib.md5(s.encode("utf-8")).hexdigest()
-
 def get_stations():
 
     lines = json.load(open("data/london_underground_lines.json", "rb"))
@@ -28,31 +59,92 @@ def get_stations():
 
     return piccadilly
 
-def get_crowding(station, direction):
+def station_crowding(station, crowding_api, timings=None):
 
-    crowding_data = _live_crowding(best_station_match(station)[0])
+    with stage(timings, "match"):
+        naptan = best_station_match(station)[1]
 
-    img_path = get_graphic(station, direction)
+    with stage(timings, "fetch"):
+        crowding_data = crowding_api.payload(naptan, station)
 
     if crowding_data['dataAvailable'] == True:
-        data = str(crowding_data['percentageOfBaseline'])
-    else:
-        data = str(1.)
+        return str(crowding_data['percentageOfBaseline'])
+    return str(1.)
+
+def get_crowding(station, direction):
+
+    timings = Timings()
 
-    return jsonify({
+    crowding_api = BudgetedCrowding(Deadline(CROWDING_DEADLINE))
+
+    data = station_crowding(station, crowding_api, timings)
+
+    img_url = get_graphic(station, direction, crowding_api, timings)
+
+    response = jsonify({
         "crowding": data,
-        "image_url": url_for("static", filename=img_path)
+        "image_url": img_url,
+        "degraded": crowding_api.degraded,
     })
 
-def get_graphic(station, direction):
+    return timed(response, timings, crowding_api, station=station, direction=direction)
+
+def get_profile(station, direction):
+
+    timings = Timings()
+
+    crowding_api = BudgetedCrowding(Deadline(CROWDING_DEADLINE))
+
+    data = station_crowding(station, crowding_api, timings)
+
+    _, levels = live_profile(current_time_str(), station, direction, 'data', 'data/historical_maxima.json', crowding_api, bins=200, std=30, line_key="Piccadilly", timings=timings)
+
+    response = jsonify({
+        "crowding": data,
+        "degraded": crowding_api.degraded,
+        "bins": len(levels),
+        "profile": base64.b64encode(levels.tobytes()).decode("ascii"),
+        "encoding": "uint8-base64",
+        "color": line_color("Piccadilly"),
+        "overlay_url": url_for("assets", filename="trainsparency.png"),
+    })
+
+    return timed(response, timings, crowding_api, station=station, direction=direction)
+
+def timed(response, timings, crowding_api, **fields):
+    """Add the Server-Timing header and log the request's stage timings."""
+
+    timings.note("fetch", f"{crowding_api.hits} hit, {crowding_api.misses} miss")
+    response.headers["Server-Timing"] = timings.header()
+
+    app.logger.info(json.dumps({
+        "path": request.path,
+        "status": response.status_code,
+        **fields,
+        **timings.as_dict(),
+        "degraded": len(crowding_api.degraded),
+    }))
+    return response
+
+def render_graphic(station, direction, current_time, crowding_api=None, timings=None):
+    if crowding_api is None:
+        crowding_api = BudgetedCrowding(Deadline(CROWDING_DEADLINE))
+    return live_overlay(current_time, station, direction, 'data', 'data/historical_maxima.json', crowding_api, bins=200, std=30, overlay_path="assets/trainsparency.png", line_key="Piccadilly", cache=OVERLAY_CACHE, timings=timings)
+
+def get_graphic(station, direction, crowding_api=None, timings=None):
 
     current_time = current_time_str()
 
-    file_name = f"{md5_of_string(station + direction + str(current_time))}.png"
+    key, _ = render_graphic(station, direction, current_time, crowding_api, timings)
 
-    generate_live_overlay(current_time, station, direction, 'data', 'data/historical_maxima.json', f"static/{file_name}", live_crowding, bins=200, std=30, overlay_path="assets/trainsparency.png", line_key="Piccadilly")
+    # the render inputs let another worker, without this key in memory, redraw it
+    return url_for("overlay", key=key, station=station, direction=direction, t=current_time)
 
-    return file_name
+def png_response(data, etag, cache_control):
+    response = Response(data, mimetype="image/png")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
 
 @app.get("/")
 def index():
@@ -65,6 +157,41 @@ def crowding():
     direction = request.args.get("direction", "WB")
     return get_crowding(station, direction)
 
+@app.get("/crowding/profile")
+def crowding_profile():
+    station = request.args.get("station")
+    direction = request.args.get("direction", "WB")
+    return get_profile(station, direction)
+
+@app.get("/assets/<path:filename>")
+def assets(filename):
+    return send_from_directory("assets", filename, max_age=86400)
+
+@app.get("/overlay/<key>.png")
+def overlay(key):
+    if request.if_none_match.contains(key):
+        return png_response(None, key, IMMUTABLE), 304
+
+    data = OVERLAY_CACHE.get(key)
+    if data is not None:
+        return png_response(data, key, IMMUTABLE)
+
+    station = request.args.get("station")
+    direction = request.args.get("direction", "WB")
+    current_time = request.args.get("t")
+    if not station or not current_time:
+        abort(404)
+
+    try:
+        fresh_key, data = render_graphic(station, direction, current_time)
+    except (KeyError, ValueError):
+        abort(404)
+
+    if fresh_key != key:
+        # live inputs moved on since the URL was issued; serve the current image
+        return png_response(data, fresh_key, "no-cache")
+    return png_response(data, key, IMMUTABLE)
+
 @app.get("/healthz")
 def healthz():
     return "ok"
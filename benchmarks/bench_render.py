@@ -0,0 +1,59 @@
+"""
+Compare the matplotlib and NumPy/Pillow overlay renderers per image.
+
+    python benchmarks/bench_render.py [--station "South Kensington"] [--repeat 10]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from occupancy import RENDERERS, route_mixture, crowding_api_dummy
+
+def _time_renderer(name, centers, mix_total, repeat):
+    times = []
+    for _ in range(repeat):
+        buf = io.BytesIO()
+        t0 = time.perf_counter()
+        RENDERERS[name](centers, mix_total, buf, "assets/trainsparency.png", "Piccadilly")
+        times.append(time.perf_counter() - t0)
+    return np.array(times), buf.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--station", default="South Kensington")
+    parser.add_argument("--direction", default="WB")
+    parser.add_argument("--time", default="09:35")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    centers, mix_total = route_mixture(args.time, args.station, args.direction, "data", "data/historical_maxima.json", crowding_api_dummy)
+
+    images = {}
+    for name in RENDERERS:
+        # first call pays for imports / overlay scaling, report it separately
+        first, _ = _time_renderer(name, centers, mix_total, 1)
+        times, png = _time_renderer(name, centers, mix_total, args.repeat)
+        images[name] = np.asarray(Image.open(io.BytesIO(png)), dtype=int)
+        print(f"{name:>10}: first {first[0] * 1e3:8.1f} ms  median {np.median(times) * 1e3:8.1f} ms  "
+              f"min {times.min() * 1e3:8.1f} ms  ({len(png) / 1024:.0f} KiB)")
+
+    a, b = images["matplotlib"], images["numpy"]
+    if a.shape != b.shape:
+        print(f"shape mismatch: matplotlib {a.shape} vs numpy {b.shape}")
+    else:
+        diff = np.abs(a - b)
+        print(f"pixel diff: max {diff.max()}  mean {diff.mean():.4f}  >2 levels {np.mean(diff > 2):.2e}")
+
+if __name__ == "__main__":
+    main()
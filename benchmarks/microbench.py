@@ -0,0 +1,210 @@
+"""
+Microbenchmarks of the hot paths, compared against a stored baseline.
+
+    python benchmarks/microbench.py [-k mixture] [--threshold 0.25]
+    python benchmarks/microbench.py --save-baseline
+
+Each benchmark is timed `--repeat` times over enough calls to take about
+`--min-time` seconds; the median time per call is compared with
+benchmarks/baseline.json and anything slower by more than `--threshold`
+(a fraction) is reported as a regression, with exit status 1. Baselines are
+only meaningful on the machine that recorded them; re-save after moving.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import crowding
+import occupancy
+import render
+import routes
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+STATION = "South Kensington"
+DIRECTION = "WB"
+TKEY = "0930"
+
+BENCHMARKS = {}
+
+def bench(name):
+    """Register a setup function returning the zero-argument callable to time."""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+@bench("best_station_match")
+def _station_match():
+    names = list(routes.line_stations("Piccadilly")) + ["kings cross", "Heathrow", "South Ken", "Leicester Sq"]
+    match = crowding.best_station_match.__wrapped__  # bypass the LRU of recent inputs
+    crowding._station_index()
+    cycle = itertools.cycle(names)
+    return lambda: match(next(cycle))
+
+@bench("truncnorm_row")
+def _truncnorm():
+    centers = occupancy._bin_centers(200)
+    return lambda: occupancy._truncnorm_row(centers, 42.0, 30)
+
+@bench("route_mixture")
+def _mixture():
+    index = routes.route_index("data", "Piccadilly")
+    upstream, n_routes = index.routes(STATION, DIRECTION, TKEY)
+    weights = np.random.default_rng(0).random(len(index.stations))
+    K = occupancy.kernel_matrix("Piccadilly", DIRECTION, 30, 200)
+    return lambda: occupancy._mixture(upstream, n_routes, weights, K)
+
+@bench("hdf5_route_load")
+def _hdf5_load():
+    index = routes.RouteIndex("data", "Piccadilly")
+    path = os.path.join("data", f"{routes._sanitize_station_name(STATION)}.h5")
+    if not os.path.exists(path):
+        return None
+    return lambda: index._read_station(STATION)
+
+@bench("route_store_lookup")
+def _store_lookup():
+    path = routes.store_path("data", "Piccadilly")
+    if not os.path.exists(path):
+        return None
+    store = routes.RouteStore(path)
+    return lambda: store.routes(STATION, DIRECTION, TKEY)
+
+def _mix_total():
+    index = routes.route_index("data", "Piccadilly")
+    upstream, n_routes = index.routes(STATION, DIRECTION, TKEY)
+    weights = np.random.default_rng(0).random(len(index.stations))
+    return occupancy._mixture(upstream, n_routes, weights, occupancy.kernel_matrix("Piccadilly", DIRECTION, 30, 200))
+
+@bench("png_render")
+def _png_render():
+    mix_total = _mix_total()
+    color = occupancy.line_color("Piccadilly")
+    render.render_strip(mix_total, color)
+    return lambda: render.render_strip(mix_total, color)
+
+@bench("png_encode")
+def _png_encode():
+    img = render.render_strip(_mix_total(), occupancy.line_color("Piccadilly"))
+    return lambda: render.encode_png(img, io.BytesIO())
+
+@bench("ttl_cache_contention")
+def _ttl_cache():
+    # 8 threads sharing one cache (serialised by its lock), mostly hits with a
+    # write every 16th call; one timed call is a full round of 8 x 256 operations
+    cache = crowding.JitteredTTLCache(maxsize=1024, ttl=900, jitter=60, stale_ttl=600)
+    keys = [("940GZZLU%03d" % i,) for i in range(64)]
+    for k in keys:
+        cache[k] = {"dataAvailable": True, "percentageOfBaseline": 0.5}
+
+    def worker(offset):
+        for i in range(256):
+            k = keys[(offset + i) % len(keys)]
+            if i % 16 == 0:
+                cache[k] = {"dataAvailable": True, "percentageOfBaseline": 0.5}
+            else:
+                cache.get(k)
+                cache.is_stale(k)
+
+    def run():
+        threads = [threading.Thread(target=worker, args=(t * 8,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    return run
+
+def _run(fn, number):
+    t0 = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - t0
+
+def measure(fn, repeat, min_time):
+    """Median and minimum seconds per call of `fn`, over `repeat` runs of about `min_time` each."""
+
+    # calibrate the number of calls per run, like timeit's autorange
+    number = 1
+    elapsed = _run(fn, number)
+    while elapsed < min_time and number < 1 << 20:
+        number = min(1 << 20, max(2 * number, int(number * min_time / max(elapsed, 1e-9))))
+        elapsed = _run(fn, number)
+
+    times = [_run(fn, number) / number for _ in range(repeat)]
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "number": number}
+
+def _fmt(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.1f} ns"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", dest="pattern", default=None, help="only run benchmarks matching this regex")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat, roughly")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown of the median, as a fraction")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        baseline = json.load(open(args.baseline))["results"]
+
+    results = {}
+    regressions = []
+    for name, setup in BENCHMARKS.items():
+        if args.pattern and not re.search(args.pattern, name):
+            continue
+        fn = setup()
+        if fn is None:
+            print(f"{name:>22}: skipped (no input data)")
+            continue
+
+        results[name] = r = measure(fn, args.repeat, args.min_time)
+        line = f"{name:>22}: median {_fmt(r['median'])}  min {_fmt(r['min'])}"
+
+        old = baseline.get(name)
+        if old:
+            change = r["median"] / old["median"] - 1
+            line += f"  {change:+7.1%} vs baseline"
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "results": results,
+            }, fh, indent=2)
+            fh.write("\n")
+        print(f"baseline written to {os.path.relpath(args.baseline)}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
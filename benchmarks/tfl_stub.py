@@ -0,0 +1,200 @@
+"""
+Local stand-in for the TfL endpoints the app calls, for load tests without
+network or API quota.
+
+    python benchmarks/tfl_stub.py [--port 8081] [--latency 0.05] [--error-rate 0.01]
+    TFL_BASE_URL=http://127.0.0.1:8081 flask --app app run
+
+Serves /crowding/{naptan}/Live, /StopPoint/Search/{name} and
+/StopPoint/Mode/{mode}/ from JSON fixtures in --fixtures (one file per
+request path). Paths without a fixture are answered from the local station
+catalog, with a fixed made-up crowding level per station. With --record URL,
+missing fixtures are fetched from that upstream (e.g. https://api.tfl.gov.uk,
+using TFL_APP_KEY) and saved, so later runs replay them offline.
+
+Latency and errors are injected on every TfL path: a delay of --latency
+seconds (+/- --jitter), --error-rate of responses answered with
+--error-status, and --hang-rate of requests held for --hang seconds. They can
+be changed while running:
+
+    curl -X POST localhost:8081/_stub/config -d '{"latency": 2, "error_rate": 0.5}'
+    curl localhost:8081/_stub/stats
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import zlib
+
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures", "tfl")
+CATALOG = os.path.join(ROOT, "data", "stations_catalog.json")
+
+# injection settings, changeable through /_stub/config
+DEFAULT_CONFIG = {
+    "latency": 0.0,
+    "jitter": 0.0,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "hang_rate": 0.0,
+    "hang": 30.0,
+}
+
+def fixture_name(path):
+    return re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") + ".json"
+
+def load_catalog(path=CATALOG):
+    catalog = json.load(open(path, "r"))
+    return [dict(zip(catalog["fields"], row)) for row in catalog["rows"]]
+
+def synthetic_crowding(naptan):
+    """A stable, made-up live payload: the same level for a station every time."""
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return {
+        "dataAvailable": True,
+        "percentageOfBaseline": round(0.2 + (zlib.crc32(naptan.encode()) % 1000) / 1000, 3),
+        "timeUtc": now.isoformat().replace("+00:00", "Z"),
+        "timeLocal": now.isoformat(),
+    }
+
+def synthetic_search(stations, name):
+    needle = name.lower()
+    matches = [sp for sp in stations if needle in sp["commonName"].lower()]
+    # TfL lists station-level ids first
+    matches.sort(key=lambda sp: not sp["naptanId"].startswith("940G"))
+    return {
+        "query": name,
+        "total": len(matches),
+        "matches": [{"id": sp["naptanId"], "name": sp["commonName"], "lat": sp["lat"], "lon": sp["lon"]} for sp in matches],
+    }
+
+def synthetic_stop_points(stations, stop_type=None):
+    return {"stopPoints": [sp for sp in stations if stop_type is None or sp["stopType"] in stop_type.split(",")]}
+
+def make_app(fixtures=FIXTURES, catalog=CATALOG, record=None, app_key=None, **config):
+    """The stub as an aiohttp application; `config` overrides DEFAULT_CONFIG."""
+
+    app = web.Application(middlewares=[_inject])
+    app["config"] = dict(DEFAULT_CONFIG, **config)
+    app["stats"] = Counter()
+    app["fixtures"] = fixtures
+    app["stations"] = load_catalog(catalog)
+    app["record"] = record.rstrip("/") if record else None
+    app["app_key"] = app_key
+
+    app.router.add_get("/crowding/{naptan}/Live", _crowding)
+    app.router.add_get("/StopPoint/Search/{name}", _search)
+    app.router.add_get("/StopPoint/Mode/{mode}/", _stop_points)
+    app.router.add_get("/_stub/config", _get_config)
+    app.router.add_post("/_stub/config", _set_config)
+    app.router.add_get("/_stub/stats", _get_stats)
+    app.on_cleanup.append(_close_upstream)
+    return app
+
+@web.middleware
+async def _inject(request, handler):
+    if request.path.startswith("/_stub/"):
+        return await handler(request)
+
+    config = request.app["config"]
+    stats = request.app["stats"]
+    stats["requests"] += 1
+
+    r = random.random()
+    if r < config["hang_rate"]:
+        stats["hung"] += 1
+        await asyncio.sleep(config["hang"])
+    elif r < config["hang_rate"] + config["error_rate"]:
+        stats["errors"] += 1
+        return web.json_response({"message": "injected error"}, status=config["error_status"])
+
+    delay = config["latency"] + random.uniform(-config["jitter"], config["jitter"])
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return await handler(request)
+
+async def _replay(request, synthetic):
+    """Answer from the fixture for this path, else record it from upstream, else `synthetic()`."""
+
+    app = request.app
+    path = os.path.join(app["fixtures"], fixture_name(request.path))
+    if os.path.exists(path):
+        app["stats"]["replayed"] += 1
+        return web.Response(body=open(path, "rb").read(), content_type="application/json")
+
+    if app["record"]:
+        status, body = await _fetch_upstream(app, request)
+        if status == 200:
+            os.makedirs(app["fixtures"], exist_ok=True)
+            with open(path + ".tmp", "wb") as fh:
+                fh.write(body)
+            os.replace(path + ".tmp", path)
+            app["stats"]["recorded"] += 1
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    app["stats"]["synthetic"] += 1
+    return web.json_response(synthetic())
+
+async def _fetch_upstream(app, request):
+    if "upstream" not in app:
+        app["upstream"] = ClientSession()
+    params = {k: v for k, v in request.query.items() if k != "app_key"}
+    if app["app_key"]:
+        params["app_key"] = app["app_key"]
+    async with app["upstream"].get(app["record"] + request.path, params=params) as r:
+        return r.status, await r.read()
+
+async def _close_upstream(app):
+    if "upstream" in app:
+        await app["upstream"].close()
+
+async def _crowding(request):
+    return await _replay(request, lambda: synthetic_crowding(request.match_info["naptan"]))
+
+async def _search(request):
+    return await _replay(request, lambda: synthetic_search(request.app["stations"], request.match_info["name"]))
+
+async def _stop_points(request):
+    return await _replay(request, lambda: synthetic_stop_points(request.app["stations"], request.query.get("stopType")))
+
+async def _get_config(request):
+    return web.json_response(request.app["config"])
+
+async def _set_config(request):
+    changes = await request.json()
+    unknown = set(changes) - set(DEFAULT_CONFIG)
+    if unknown:
+        return web.json_response({"message": f"unknown settings: {sorted(unknown)}"}, status=400)
+    request.app["config"].update(changes)
+    return web.json_response(request.app["config"])
+
+async def _get_stats(request):
+    return web.json_response(dict(request.app["stats"]))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve recorded or synthetic TfL responses locally.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--catalog", default=CATALOG)
+    parser.add_argument("--record", metavar="URL", default=None, help="fetch and save missing fixtures from this upstream")
+    for name, default in DEFAULT_CONFIG.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in DEFAULT_CONFIG}
+    app = make_app(args.fixtures, args.catalog, record=args.record, app_key=os.getenv("TFL_APP_KEY"), **config)
+
+    print(f"TfL stub on http://{args.host}:{args.port} ({'recording from ' + args.record if args.record else 'replaying'} {args.fixtures})", file=sys.stderr)
+    web.run_app(app, host=args.host, port=args.port, print=None)
@@ -1,37 +1,82 @@
-import os, json, pathlib, requests
+import os, json, pathlib
+import atexit
+import sqlite3
 from rapidfuzz import process, fuzz
+from rapidfuzz.utils import default_process
 
 import logging
 import random
 
 import time
 
-from functools import cache
-from cachetools import TTLCache, cached
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+from types import MappingProxyType
+
+from collections.abc import MutableMapping
+from functools import cache, lru_cache, wraps
+from cachetools import TTLCache
+from cachetools.keys import hashkey
 from xml.dom import NamespaceErr
 
+from crowding_log import CrowdingLog
+
+from tfl_client import TFL_BASE_URL as DEFAULT_TFL_BASE_URL, CircuitBreaker, CircuitOpenError, TfLClient, TfLError
+
+from urllib.parse import urlsplit
+
 logger = logging.getLogger(__name__)
 
-# custom TTL cache with jittered expiry
+# custom TTL cache with jittered expiry; with stale_ttl > 0, an expired entry is
+# still returned for up to stale_ttl seconds (see is_stale) before it becomes a miss.
+# cachetools caches aren't thread-safe, so every access goes through one RLock
+# (re-entrant: setting an item may evict through popitem)
 class JitteredTTLCache(TTLCache):
-    def __init__(self, maxsize=1024, ttl=900, jitter=60):
-        super().__init__(maxsize=maxsize, ttl=int(ttl) + int(jitter))
+    def __init__(self, maxsize=1024, ttl=900, jitter=60, stale_ttl=0):
+        super().__init__(maxsize=maxsize, ttl=int(ttl) + int(jitter) + int(stale_ttl))
         self.base_ttl = int(ttl)
         self.jitter = int(jitter)
+        self.stale_ttl = int(stale_ttl)
         self._expiries = {}
+        self._lock = threading.RLock()
 
     def __setitem__(self, key, value):
         expiry = time.monotonic() + (self.base_ttl + random.randint(-self.jitter, self.jitter))
-        self._expiries[key] = expiry
-        return super().__setitem__(key, value)
+        with self._lock:
+            self._expiries[key] = expiry
+            return super().__setitem__(key, value)
 
     def __getitem__(self, key):
-        expiry = self._expiries.get(key)
-        if expiry is not None and time.monotonic() >= expiry:
+        with self._lock:
+            expiry = self._expiries.get(key)
+            if expiry is not None and time.monotonic() >= expiry + self.stale_ttl:
+                self._expiries.pop(key, None)
+                super().pop(key, None)
+                raise KeyError(key)
+            return super().__getitem__(key)
+
+    def __delitem__(self, key):
+        with self._lock:
             self._expiries.pop(key, None)
-            super().pop(key, None)
-            raise KeyError(key)
-        return super().__getitem__(key)
+            return super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+    def __len__(self):
+        with self._lock:
+            return super().__len__()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(super().__iter__()))
+
+    def __repr__(self):
+        with self._lock:
+            return super().__repr__()
 
     def get(self, key, default=None):
         try:
@@ -39,18 +84,261 @@ class JitteredTTLCache(TTLCache):
         except KeyError:
             return default
 
+    def is_stale(self, key):
+        """True if `key` is past its jittered expiry but still inside the stale window."""
+        with self._lock:
+            expiry = self._expiries.get(key)
+        return expiry is not None and time.monotonic() >= expiry
+
     def pop(self, key, *args):
-        self._expiries.pop(key, None)
-        return super().pop(key, *args)
+        with self._lock:
+            self._expiries.pop(key, None)
+            return super().pop(key, *args)
 
     def popitem(self):
-        k, v = super().popitem()
-        self._expiries.pop(k, None)
-        return k, v
+        with self._lock:
+            k, v = super().popitem()
+            self._expiries.pop(k, None)
+            return k, v
+
+    def expire(self, time=None):
+        with self._lock:
+            expired = super().expire(time)
+            for k, _ in expired:
+                self._expiries.pop(k, None)
+            return expired
 
     def clear(self):
-        self._expiries.clear()
-        super().clear()
+        with self._lock:
+            self._expiries.clear()
+            super().clear()
+
+class SQLiteTTLCache(MutableMapping):
+    """
+    TTL cache (same jittered expiry and stale window as JitteredTTLCache)
+    kept in a SQLite file in WAL mode, so every worker process on the host
+    shares one copy. Values must be JSON-serialisable. `claim` hands out
+    short leases so that only one process refreshes a key at a time.
+    """
+
+    def __init__(self, path, maxsize=1024, ttl=900, jitter=60, stale_ttl=0):
+        self.path = str(path)
+        self.maxsize = maxsize
+        self.base_ttl = int(ttl)
+        self.jitter = int(jitter)
+        self.stale_ttl = int(stale_ttl)
+        self._local = threading.local()
+
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, stale_until REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, until REAL NOT NULL)")
+            # files written before the stale window have no stale_until
+            if "stale_until" not in [row[1] for row in db.execute("PRAGMA table_info(entries)")]:
+                db.execute("ALTER TABLE entries ADD COLUMN stale_until REAL NOT NULL DEFAULT 0")
+                db.execute("UPDATE entries SET stale_until = expires")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _db(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _key(key):
+        return "|".join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+    def __getitem__(self, key):
+        row = self._db().execute("SELECT value, stale_until FROM entries WHERE key = ?", (self._key(key),)).fetchone()
+        if row is None or time.time() >= row[1]:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        expires = time.time() + self.base_ttl + random.randint(-self.jitter, self.jitter)
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (self._key(key), json.dumps(value), expires, expires + self.stale_ttl))
+        db.execute("DELETE FROM leases WHERE key = ?", (self._key(key),))
+        if random.random() < 0.05:
+            self.expire()
+
+    def __delitem__(self, key):
+        if self._db().execute("DELETE FROM entries WHERE key = ?", (self._key(key),)).rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        rows = self._db().execute("SELECT key FROM entries WHERE stale_until > ?", (time.time(),)).fetchall()
+        return iter([r[0] for r in rows])
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM entries WHERE stale_until > ?", (time.time(),)).fetchone()[0]
+
+    def is_stale(self, key):
+        """True if `key` is past its jittered expiry but still inside the stale window."""
+        row = self._db().execute("SELECT expires, stale_until FROM entries WHERE key = ?", (self._key(key),)).fetchone()
+        return row is not None and row[0] <= time.time() < row[1]
+
+    def expire(self):
+        """Drop entries past their stale window and expired leases, then the soonest-expiring entries beyond maxsize."""
+        now = time.time()
+        db = self._db()
+        db.execute("DELETE FROM entries WHERE stale_until <= ?", (now,))
+        db.execute("DELETE FROM leases WHERE until <= ?", (now,))
+        db.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+    def clear(self):
+        db = self._db()
+        db.execute("DELETE FROM entries")
+        db.execute("DELETE FROM leases")
+
+    def claim(self, key, lease=30):
+        """True if this caller now holds the refresh lease for `key` (for `lease` seconds)."""
+        now = time.time()
+        db = self._db()
+        db.execute("DELETE FROM leases WHERE key = ? AND until <= ?", (self._key(key), now))
+        return db.execute("INSERT OR IGNORE INTO leases VALUES (?, ?)", (self._key(key), now + lease)).rowcount == 1
+
+    def release(self, key):
+        """Give up the lease on `key` early, e.g. when the refresh failed."""
+        self._db().execute("DELETE FROM leases WHERE key = ?", (self._key(key),))
+
+def _make_station_cache():
+    """SQLite cache shared by all workers when CROWDING_CACHE_PATH is set, else per-process memory."""
+    path = os.getenv("CROWDING_CACHE_PATH")
+    if path:
+        return SQLiteTTLCache(path, maxsize=1024, ttl=900, jitter=60, stale_ttl=600)
+    return JitteredTTLCache(maxsize=1024, ttl=900, jitter=60, stale_ttl=600)
+
+def _shared_cached(cache, lease=35, poll=0.05, wait_timeout=35, on_timeout=None, executor=None, guard=None):
+    """
+    Like cachetools.cached, with single-flight misses and stale-while-revalidate.
+
+    If the cache backend has `is_stale` and a hit is stale, the stale value is
+    returned at once and one refresh of the key is run on `executor`.
+
+    Within a process, the first caller to miss a key computes it and concurrent
+    callers for the same key wait up to `wait_timeout` seconds for that result
+    (then get `on_timeout(*args)`, or a TimeoutError if it is None). Across
+    processes, if the cache backend has `claim`, only the caller holding the
+    claim computes; others poll the cache for it until the lease runs out,
+    then compute it themselves.
+    """
+    inflight = {}
+    lock = threading.Lock()
+
+    def decorator(func):
+        def load(key, args):
+            # a leader may have just filled it between our miss and taking the lead
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+
+            if guard is not None:
+                guard(*args)
+
+            claim = getattr(cache, "claim", None)
+            claimed = claim is not None and claim(key, lease)
+            if claim is not None and not claimed:
+                deadline = time.monotonic() + lease
+                while time.monotonic() < deadline:
+                    time.sleep(poll)
+                    try:
+                        return cache[key]
+                    except KeyError:
+                        pass
+
+            try:
+                value = func(*args)
+            except BaseException:
+                # let another process try now rather than wait out the lease
+                if claimed:
+                    cache.release(key)
+                raise
+            try:
+                cache[key] = value
+            except ValueError:
+                pass
+            return value
+
+        def revalidate(key, args, future):
+            # a failed refresh raises and leaves the stale entry in place
+            try:
+                value = func(*args)
+                try:
+                    cache[key] = value
+                except ValueError:
+                    pass
+                future.set_result(value)
+            except BaseException as e:
+                logger.error("Background refresh of %s failed: %s", key, e)
+                future.set_exception(e)
+            finally:
+                with lock:
+                    inflight.pop(key, None)
+
+        def schedule(key, args):
+            with lock:
+                if key in inflight:
+                    return
+                future = inflight[key] = Future()
+            executor.submit(revalidate, key, args, future)
+
+        is_stale = getattr(cache, "is_stale", None)
+
+        @wraps(func)
+        def wrapper(*args):
+            key = hashkey(*args)
+            try:
+                value = cache[key]
+                if executor is not None and is_stale is not None and is_stale(key):
+                    schedule(key, args)
+                return value
+            except KeyError:
+                pass
+
+            with lock:
+                future = inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = inflight[key] = Future()
+
+            if not leader:
+                try:
+                    return future.result(timeout=wait_timeout)
+                except FuturesTimeoutError:
+                    if on_timeout is None:
+                        raise
+                    return on_timeout(*args)
+
+            try:
+                value = load(key, args)
+                future.set_result(value)
+                return value
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with lock:
+                    inflight.pop(key, None)
+
+        wrapper.inflight = inflight
+        wrapper.lock = lock
+        wrapper.schedule = schedule
+        return wrapper
+    return decorator
 
 def _load_app_key() -> str | None:
     """Read the TfL API key from an env var or Docker secret."""
@@ -68,47 +356,170 @@ def _load_app_key() -> str | None:
 
 APP_KEY = _load_app_key()
 
-_SESSION = requests.Session()
+# one event loop thread and a bounded connection pool for all TfL calls
+# TFL_BASE_URL points the app at another server, e.g. benchmarks/tfl_stub.py
+TFL_BASE_URL = os.getenv("TFL_BASE_URL", DEFAULT_TFL_BASE_URL)
+
+_TFL = TfLClient(
+    TFL_BASE_URL,
+    app_key=APP_KEY,
+    limit=int(os.getenv("TFL_POOL_SIZE", "32")),
+    timeout=30,
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("TFL_BREAKER_FAILURES", "5")),
+        slow_call=float(os.getenv("TFL_BREAKER_SLOW_CALL", "5")),
+    ),
+)
+atexit.register(_TFL.close)
 
 CACHE   = pathlib.Path.home() / ".cache/tfl_tube_stations.json"
 
-_STATION_CACHE = JitteredTTLCache(maxsize=1024, ttl=900, jitter=60)
+_STATION_CACHE = _make_station_cache()
+
+# every live payload fetched is appended here when CROWDING_LOG_DIR is set
+_CROWDING_LOG = CrowdingLog(os.environ["CROWDING_LOG_DIR"]) if os.getenv("CROWDING_LOG_DIR") else None
 
-_LAST_CALL = 0.0
+# background refreshes of stale entries
+_REVALIDATE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tfl-revalidate")
+
+# caching and recording batch fetch results, which blocks on SQLite and the
+# crowding log, kept off the TfL client's event loop
+_SETTLE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tfl-settle")
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, holding at most `burst`.
+
+    `acquire` reserves a token and sleeps (outside the lock) until it is due, so
+    concurrent callers are spaced out instead of waking together; `reserve`
+    leaves the waiting to the caller. `try_acquire`
+    never waits, for background work that should only use spare capacity.
+    """
 
-def _rate_limited(min_interval=0.1):
-    """Decorator factory to ensure a minimum interval between calls."""
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.rejections = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.acquired += 1
+                return True
+            self.rejections += 1
+            return False
+
+    def reserve(self, timeout: float | None = None) -> float | None:
+        """
+        Take a token without waiting for it: the seconds until it is due, or
+        None (and no token) if that is more than `timeout`.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                self.rejections += 1
+                return None
+            # going negative reserves the next token for this caller
+            self._tokens -= 1
+            self.acquired += 1
+            if wait > 0:
+                self.waits += 1
+                self.wait_seconds += wait
+            return wait
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        """Take a token, waiting up to `timeout` seconds (forever if None) for it."""
+        wait = self.reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+                "rejections": self.rejections,
+            }
+
+TFL_HOST = urlsplit(TFL_BASE_URL).netloc
+
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+def rate_limiter(host: str) -> TokenBucket:
+    """The shared token bucket for an upstream host (TFL_RATE per second, TFL_BURST deep)."""
+    with _BUCKETS_LOCK:
+        if host not in _BUCKETS:
+            _BUCKETS[host] = TokenBucket(rate=float(os.getenv("TFL_RATE", "10")), burst=float(os.getenv("TFL_BURST", "5")))
+        return _BUCKETS[host]
+
+def _rate_limited(host: str = TFL_HOST):
+    """Decorator factory taking a token from `host`'s bucket before each call."""
     def decorator(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
-            global _LAST_CALL
-            since_last = time.monotonic() - _LAST_CALL
-            if since_last < min_interval:
-                time.sleep(min_interval - since_last)
-            result = func(*args, **kwargs)
-            _LAST_CALL = time.monotonic()
-            return result
+            rate_limiter(host).acquire()
+            return func(*args, **kwargs)
         return wrapper
     return decorator
 
 def _refresh_cache() -> list[dict]:
     params = {
-        "modes": "tube",
         "stopType": "NaptanMetroStation",
         "useStopPointHierarchy": "false",
-        "app_key": APP_KEY,
     }
 
-    url     = "https://api.tfl.gov.uk/StopPoint/Mode/tube/"
-
-    data = _SESSION.get(url, params=params, timeout=60).json()
+    data = _TFL.stop_points("tube", timeout=60, **params)
     CACHE.parent.mkdir(parents=True, exist_ok=True)
     CACHE.write_text(json.dumps(data, indent=2))
     return data
 
+STATIONS_JSON = 'data/stations_naptan.json'
+STATIONS_CATALOG = 'data/stations_catalog.json'
+
+# the only stop point fields the app reads
+CATALOG_FIELDS = ("commonName", "naptanId", "stopType", "lat", "lon")
+
+def build_station_catalog(records, out_path=STATIONS_CATALOG):
+    """
+    Write the slim station catalog: one row of CATALOG_FIELDS per stop point,
+    in the original order (later duplicates of a name still win).
+    """
+    rows = [[sp.get(f) for f in CATALOG_FIELDS] for sp in records]
+    tmp = out_path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump({"fields": CATALOG_FIELDS, "rows": rows}, fh, separators=(",", ":"))
+    os.replace(tmp, out_path)
+    return len(rows)
+
 def _load_stations(force_update: bool = False) -> list[dict]:
 
-    if os.path.exists('data/stations_naptan.json'):
-        return json.load(open('data/stations_naptan.json', 'r'))
+    if not force_update and os.path.exists(STATIONS_CATALOG):
+        catalog = json.load(open(STATIONS_CATALOG, 'r'))
+        return [dict(zip(catalog["fields"], row)) for row in catalog["rows"]]
+
+    if os.path.exists(STATIONS_JSON):
+        return json.load(open(STATIONS_JSON, 'r'))
 
     if force_update or not CACHE.exists():
         return _refresh_cache()
@@ -128,41 +539,120 @@ def _station_records(obj):
         return list(obj.values())
     return []
 
-_STATIONS = _station_records(_load_stations())
+@cache
+def _stations() -> list[dict]:
+    """Station records, read on first use rather than at import."""
+    return _station_records(_load_stations())
 
 def list_station_names() -> list[str]:
     """Alphabetical ‘Oxford Circus’, ‘Ealing Broadway’, …"""
-    return sorted(sp["commonName"] for sp in _STATIONS)
+    return sorted(sp["commonName"] for sp in _stations())
 
-def best_station_match(user_text: str, *, min_score: int = 80) -> tuple[str, str] | None:
+class StationIndex:
     """
-    Return (name, naptanId) for the closest match, or None if below threshold.
-    tweak `processor` / `scorer` in `process.extractOne` for different heuristics.
+    Station names prepared once for `best_station_match`: the rapidfuzz
+    candidates with their NaPTAN ids, and a normalized exact-match map of the
+    Tube stations (940G… ids) only. `lookup` resolves a plain station name
+    ("Holborn") without fuzzy matching.
+
+    Non-Tube names stay among the fuzzy candidates so that, as before, a query
+    closest to e.g. a DLR stop finds no Tube station rather than a poor one.
     """
 
-    names = {sp["commonName"]: sp["naptanId"] for sp in _STATIONS}
-    matches = process.extract(user_text, names.keys(), scorer=fuzz.WRatio, limit = 10)
-    for match in matches:
-        if match and (match[1] >= min_score) and names[match[0]].startswith("940G"):
-            return match[0], names[match[0]]
-    return None
+    def __init__(self, records):
+        names = {sp["commonName"]: sp["naptanId"] for sp in records}
+        self.names = list(names)
+        self.ids = list(names.values())
+        self.exact = {}
+        self.plain = {}
+        for name, nid in names.items():
+            if nid.startswith("940G"):
+                self.exact.setdefault(default_process(name), (name, nid))
+                self.plain.setdefault(self._plain(name), (name, nid))
+
+    @staticmethod
+    def _plain(name):
+        words = default_process(name).split()
+        for suffix in (["underground", "station"], ["station"], ["lu"]):
+            if words[-len(suffix):] == suffix:
+                return " ".join(words[: -len(suffix)])
+        return " ".join(words)
+
+    def lookup(self, name: str) -> tuple[str, str] | None:
+        """(name, naptanId) of the Tube station called `name`, ignoring case, punctuation and an "Underground Station" or "LU" suffix."""
+        return self.plain.get(self._plain(name))
+
+    def match(self, user_text: str, min_score: int = 80) -> tuple[str, str] | None:
+        exact = self.exact.get(default_process(user_text))
+        if exact is not None:
+            return exact
+
+        matches = process.extract(user_text, self.names, scorer=fuzz.WRatio, limit=10, score_cutoff=min_score)
+        for name, _, i in matches:
+            if self.ids[i].startswith("940G"):
+                return name, self.ids[i]
+        return None
 
 @cache
-def _naptan_for_station(name: str) -> str:
+def _station_index() -> StationIndex:
+    return StationIndex(_stations())
+
+@lru_cache(maxsize=1024)
+def best_station_match(user_text: str, *, min_score: int = 80) -> tuple[str, str] | None:
+    """
+    Return (name, naptanId) for the closest Tube station match, or None if below threshold.
+    tweak `processor` / `scorer` in `StationIndex.match` for different heuristics.
+    Results for recent inputs are kept in an LRU.
+    """
+    return _station_index().match(user_text, min_score=min_score)
+
+class NaptanStore:
     """
-    Resolve a human-readable Underground station name to its NaPTAN code
-    using /StopPoint/Search.  Raises ValueError if no Tube station is found.
+    Station name -> NaPTAN id resolutions kept in a JSON file, so they survive
+    restarts and deploys. Writes merge with the file's current contents and
+    are renamed into place, so workers sharing the file don't lose entries.
     """
-    url = f"https://api.tfl.gov.uk/StopPoint/Search/{name}"
-    params = {"modes": "tube", "app_key": APP_KEY}
 
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._ids = self._read()
+
+    def _read(self) -> dict:
+        try:
+            return json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, name):
+        return self._ids.get(name)
+
+    def put(self, name, naptan):
+        with self._lock:
+            ids = {**self._read(), **self._ids, name: naptan}
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+                tmp.write_text(json.dumps(ids, indent=2, sort_keys=True))
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.warning("could not persist NaPTAN ids to %s: %s", self.path, e)
+            self._ids = ids
+
+NAPTAN_STORE = NaptanStore(os.getenv("NAPTAN_CACHE_PATH") or pathlib.Path.home() / ".cache/tfl_naptan_ids.json")
+
+@_rate_limited(TFL_HOST)
+def _search_naptan(name: str) -> str:
+    """
+    Resolve a station name with /StopPoint/Search. Raises ValueError if no
+    Tube station is found.
+    """
     try:
-        r = _SESSION.get(url, params=params, timeout=30)
-        r.raise_for_status()
+        matches = _TFL.search(name, modes="tube")
     except Exception as e:
         raise ValueError(f"Connection failed: {e}")
 
-    for match in r.json().get("matches", []):
+    for match in matches:
         nid = match["id"]
         # Tube stations always start 940G…  (Bakerloo = 940GZZLU… etc.)
         if nid.startswith("940G"):
@@ -170,30 +660,258 @@ def _naptan_for_station(name: str) -> str:
 
     raise ValueError(f"No Tube station called “{name}” was found")
 
-@cached(_STATION_CACHE)
-@_rate_limited(min_interval=0.1)
-def _live_crowding(naptan: str) -> dict:
+@lru_cache(maxsize=1024)
+def _naptan_for_station(name: str) -> str:
     """
-    Return the latest crowd-level payload for a London Underground station.
-    Example field:  {'percentageOfBaseline': 0.31, 'timeUtc': '2025-07-14T09:30:00Z', …}
+    Resolve a human-readable Underground station name to its NaPTAN code:
+    from the local station catalog, then from names resolved before (on
+    disk, see NAPTAN_STORE), and only then with /StopPoint/Search, whose
+    answer is persisted. Raises ValueError if no Tube station is found.
     """
+    match = _station_index().lookup(name)
+    if match is not None:
+        return match[1]
 
-    url = f"https://api.tfl.gov.uk/crowding/{naptan}/Live"
-    params = {"app_key": APP_KEY}
+    nid = NAPTAN_STORE.get(name)
+    if nid is not None:
+        return nid
+
+    nid = _search_naptan(name)
+    NAPTAN_STORE.put(name, nid)
+    return nid
+
+def _live_payload(naptan: str, fetch) -> dict:
+    """
+    The /crowding/{naptan}/Live payload `fetch()` returns, recorded. Raises
+    TfLError on any failure, so callers never cache or publish the fallback
+    in place of data.
+    """
 
     try:
-        r = _SESSION.get(url, params=params, timeout=30)
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, dict):
-            return data
-        raise ValueError("Unexpected response format")
-    except requests.RequestException as e:
+        payload = fetch()
+    except CircuitOpenError:
+        raise
+    except TfLError as e:
         logger.error("Request for %s failed: %s", naptan, e)
+        raise
     except ValueError as e:
         logger.error("Invalid response for %s: %s", naptan, e)
+        raise TfLError(f"Invalid response for {naptan}: {e}") from e
+    _record(naptan, payload)
+    return payload
+
+def _request_live_crowding(naptan: str, timeout: float | None = None) -> dict:
+    """Uncached, unlimited /crowding/{naptan}/Live call; see `_live_payload`."""
+    return _live_payload(naptan, lambda: _TFL.live_crowding(naptan, timeout=timeout))
+
+def _record(naptan: str, payload: dict):
+    if _CROWDING_LOG is None:
+        return
+    try:
+        _CROWDING_LOG.record(naptan, payload)
+    except OSError as e:
+        logger.warning("Could not record crowding for %s: %s", naptan, e)
+
+def _unavailable(*args) -> dict:
+    """Payload used whenever live data can't be had."""
     return {"dataAvailable": False, "percentageOfBaseline": 1.0}
 
+def _check_circuit(naptan: str):
+    # while TfL is failing, give up at once rather than wait for a token or a lease
+    if _TFL.breaker.rejecting():
+        raise CircuitOpenError(f"{naptan} not fetched: circuit open")
+
+def _fetch_live_crowding(naptan: str) -> dict:
+    _check_circuit(naptan)
+    rate_limiter(TFL_HOST).acquire()
+    return _request_live_crowding(naptan)
+
+@_shared_cached(_STATION_CACHE, on_timeout=_unavailable, executor=_REVALIDATE_POOL, guard=_check_circuit)
+def _live_crowding(naptan: str) -> dict:
+    """
+    Return the latest crowd-level payload for a London Underground station.
+    Example field:  {'percentageOfBaseline': 0.31, 'timeUtc': '2025-07-14T09:30:00Z', …}
+    """
+    return _fetch_live_crowding(naptan)
+
+class LeaseHeld(TfLError):
+    """Not fetched: another worker holds the shared-cache lease, and its payload arrives through the cache."""
+
+def _start_fetches(naptans, timeout: float) -> dict:
+    """
+    Start `_live_crowding` fetches for several NaPTANs without waiting: a
+    Future of the payload per NaPTAN. A station already being fetched in this
+    process is joined rather than fetched again, and one whose lease another
+    worker holds gets None (its payload arrives through the shared cache).
+    The rest are fetched concurrently with `timeout` seconds each, in one
+    gather on the TfL client's loop, each held back until its rate limit
+    token is due; successful payloads are cached, a failure sets the TfLError.
+    """
+    futures, todo = {}, []
+    claim = getattr(_STATION_CACHE, "claim", None)
+    rejecting = _TFL.breaker.rejecting()
+
+    with _live_crowding.lock:
+        for naptan in naptans:
+            key = hashkey(naptan)
+            future = _live_crowding.inflight.get(key)
+            if future is None and rejecting:
+                future = Future()
+                future.set_exception(CircuitOpenError(f"{naptan} not fetched: circuit open"))
+            elif future is None:
+                future = _live_crowding.inflight[key] = Future()
+                todo.append(naptan)
+            futures[naptan] = future
+
+    # claims write to SQLite, so they're taken outside the process-wide lock;
+    # a station lost to another worker is dropped again
+    if claim is not None:
+        for naptan in [n for n in todo if not claim(hashkey(n), 35)]:
+            todo.remove(naptan)
+            with _live_crowding.lock:
+                _live_crowding.inflight.pop(hashkey(naptan), None)
+            futures[naptan].set_exception(LeaseHeld(f"{naptan} is being fetched by another worker"))
+            futures[naptan] = None
+
+    if todo:
+        limiter = rate_limiter(TFL_HOST)
+        delays = [limiter.reserve() for _ in todo]
+        for naptan, fetched in zip(todo, _TFL.live_crowding_many(todo, timeout=timeout, delays=delays)):
+            fetched.add_done_callback(lambda fetched, naptan=naptan: _SETTLE_POOL.submit(_settle, naptan, futures[naptan], fetched))
+    return futures
+
+def _settle(naptan: str, future: Future, fetched: Future):
+    # runs on _SETTLE_POOL as each fetch of _start_fetches finishes
+    key = hashkey(naptan)
+    try:
+        payload = _live_payload(naptan, fetched.result)
+    except BaseException as e:
+        future.set_exception(e)
+        release = getattr(_STATION_CACHE, "release", None)
+        if release is not None:
+            release(key)
+    else:
+        # waiters needn't wait for the cache write; it is done before the
+        # fetch leaves the single-flight table, so late callers still find it
+        future.set_result(payload)
+        _STATION_CACHE[key] = payload
+    finally:
+        with _live_crowding.lock:
+            _live_crowding.inflight.pop(key, None)
+
+class CrowdingSnapshot:
+    """Immutable set of live payloads by NaPTAN, published whole by CrowdingRefresher."""
+
+    def __init__(self, payloads: dict, taken_at: float):
+        self.payloads = MappingProxyType(dict(payloads))
+        self.taken_at = taken_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.taken_at
+
+_SNAPSHOT = CrowdingSnapshot({}, float("-inf"))
+
+# ignore the snapshot if the refresher has stopped publishing
+SNAPSHOT_MAX_AGE = 1800
+
+def _snapshot_payload(naptan: str) -> dict | None:
+    snapshot = _SNAPSHOT
+    if snapshot.age() > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot.payloads.get(naptan)
+
+def live_crowding_payload(naptan: str) -> dict:
+    """
+    Latest payload for a NaPTAN: from the refresher's snapshot if it has it,
+    else via the TTL cache, else (TfL failing) the uncached fallback.
+    """
+    payload = _snapshot_payload(naptan)
+    if payload is not None:
+        return payload
+    try:
+        return _live_crowding(naptan)
+    except TfLError:
+        return _unavailable()
+
+class CrowdingRefresher:
+    """
+    Background thread that polls live crowding for every station of a line
+    every `interval` seconds and publishes the results as a new snapshot, so
+    requests read TfL data without waiting on it. A station TfL fails for
+    keeps its cached payload, or is left out; the fallback is never published.
+    """
+
+    def __init__(self, station_names, interval: float = 300):
+        self.station_names = list(station_names)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> CrowdingSnapshot:
+        global _SNAPSHOT
+
+        payloads = {}
+        for name in self.station_names:
+            station = best_station_match(name)
+            if not station:
+                logger.error("No station match for %s", name)
+                continue
+            payload = self._refresh_station(station[1])
+            # a station TfL failed for is left out, so readers fall back to the cache
+            if payload is not None:
+                payloads[station[1]] = payload
+
+        _SNAPSHOT = CrowdingSnapshot(payloads, time.monotonic())
+        return _SNAPSHOT
+
+    def _refresh_station(self, naptan: str) -> dict | None:
+        """Fresh payload for a station, else the cached one, else None; never the fallback."""
+        key = hashkey(naptan)
+        claim = getattr(_STATION_CACHE, "claim", None)
+
+        # with a shared cache, one worker per period fetches and the rest read its result
+        if claim is None or claim(("refresh",) + key, self.interval * 0.9):
+            if _TFL.breaker.rejecting():
+                return _STATION_CACHE.get(key)
+            # only spend spare rate budget, so user requests never queue behind a sweep
+            limiter = rate_limiter(TFL_HOST)
+            while not limiter.try_acquire():
+                if self._stop.wait(1 / limiter.rate):
+                    return _STATION_CACHE.get(key)
+            try:
+                payload = _request_live_crowding(naptan)
+            except TfLError:
+                # keep what the cache has rather than overwrite it
+                return _STATION_CACHE.get(key)
+            # on-demand lookups after the snapshot expires start from this too
+            _STATION_CACHE[key] = payload
+            return payload
+
+        payload = _STATION_CACHE.get(key)
+        if payload is not None:
+            return payload
+        try:
+            return _live_crowding(naptan)
+        except TfLError:
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Crowding refresh failed: %s", e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="crowding-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
 
 def live_crowding(dodgy_station_name: str) -> float:
     try:
@@ -201,32 +919,141 @@ def live_crowding(dodgy_station_name: str) -> float:
         if not station:
             logger.error("No station match for %s", dodgy_station_name)
             return 1.0
-        response = _live_crowding(station[1])
+        response = live_crowding_payload(station[1])
         if response.get("dataAvailable"):
             return response.get("percentageOfBaseline", 1.0)
     except Exception as e:
         logger.error("Error retrieving crowding for %s: %s", dodgy_station_name, e)
     return 1.0
 
-if __name__ == "__main__":
+class Deadline:
+    """A point in time a request must answer by."""
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+class BudgetedCrowding:
+    """
+    `live_crowding` that never waits past `deadline`, for passing to occupancy
+    as its crowding function.
+
+    Stations in the snapshot or the cache are answered at once. The rest are
+    fetched (see `_start_fetches`; a station another request is already
+    fetching is waited for, not fetched again), and a station still missing
+    at the deadline, or whose fetch failed or was refused by the open circuit,
+    gets its last known payload (the cache, or the snapshot however old), or
+    the baseline 1.0. A late fetch carries on for at least the breaker's
+    slow-call time and fills the cache for later requests. Every input not
+    answered with fresh live data (including stale cache hits, refreshed in
+    the background), or not matched to a station at all, is listed in
+    `degraded`; `hits` and `misses` count lookups answered from the
+    snapshot or cache and those that went to TfL.
+    """
+
+    def __init__(self, deadline: Deadline):
+        self.deadline = deadline
+        self.degraded = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _start(self, stations: dict) -> dict:
+        """
+        Per NaPTAN of `stations` ({naptan: name}), its payload from the
+        snapshot or cache, else what `_start_fetches` gave. A stale cache hit
+        is answered (and reported as degraded) while it is refreshed in the
+        background, as `_live_crowding` does.
+        """
+        found, misses = {}, []
+        for naptan, name in stations.items():
+            payload = _snapshot_payload(naptan)
+            if payload is None:
+                key = hashkey(naptan)
+                payload = _STATION_CACHE.get(key)
+                if payload is not None and _STATION_CACHE.is_stale(key):
+                    _live_crowding.schedule(key, (naptan,))
+                    self._degrade(name)
+            if payload is not None:
+                self.hits += 1
+                found[naptan] = payload
+            else:
+                self.misses += 1
+                misses.append(naptan)
+
+        if misses:
+            # slower answers than slow_call count against TfL anyway
+            found.update(_start_fetches(misses, max(self.deadline.remaining(), _TFL.breaker.slow_call)))
+        return found
+
+    def _wait(self, name: str, naptan: str, pending) -> dict:
+        if isinstance(pending, dict):
+            return pending
+        try:
+            if pending is not None:
+                try:
+                    return pending.result(timeout=self.deadline.remaining())
+                except LeaseHeld:
+                    pass
+            # another worker is fetching it into the shared cache
+            while self.deadline.remaining() > 0:
+                time.sleep(min(0.05, self.deadline.remaining()))
+                payload = _STATION_CACHE.get(hashkey(naptan))
+                if payload is not None:
+                    return payload
+        except FuturesTimeoutError:
+            pass
+        except Exception as e:
+            logger.error("Error retrieving crowding for %s: %s", name, e)
 
-    # print(_live_crowding(best_station_match("Holborn")[0]))
-    # print(_live_crowding(best_station_match("King's Cross")[0]))
-    # print(_live_crowding(best_station_match("South Kensington")[0]))
+        self._degrade(name)
+        payload = _STATION_CACHE.get(hashkey(naptan)) or _SNAPSHOT.payloads.get(naptan)
+        return payload if payload is not None else _unavailable()
 
-    # lines = json.load(open('data/london_underground_lines.json', 'r'))
-    # picc = lines['Piccadilly']
+    def _degrade(self, name: str):
+        with self._lock:
+            if name not in self.degraded:
+                self.degraded.append(name)
 
-    # stations_plain = set()
-    # for l in picc:
-    #     stations_plain.update(l)
+    def payload(self, naptan: str, name: str | None = None) -> dict:
+        """Live payload for a NaPTAN, within the deadline."""
+        name = name or naptan
+        return self._wait(name, naptan, self._start({naptan: name})[naptan])
+
+    def __call__(self, dodgy_station_name: str) -> float:
+        return self.many([dodgy_station_name])[0]
+
+    def many(self, dodgy_station_names: list[str]) -> list[float]:
+        stations = [best_station_match(name) for name in dodgy_station_names]
+        pending = self._start({station[1]: name for name, station in zip(dodgy_station_names, stations) if station})
+
+        results = []
+        for name, station in zip(dodgy_station_names, stations):
+            if not station:
+                logger.error("No station match for %s", name)
+                self._degrade(name)
+                results.append(1.0)
+                continue
+            response = self._wait(name, station[1], pending[station[1]])
+            results.append(response.get("percentageOfBaseline", 1.0) if response.get("dataAvailable") else 1.0)
+        return results
+
+if __name__ == "__main__":
 
-    # stations_naptan = {}
-    # for station in stations_plain:
-    #     stations_naptan[station] = _naptan_for_station(station)
+    import argparse
 
-    names = {sp["commonName"]: sp["naptanId"] for sp in _STATIONS}
+    parser = argparse.ArgumentParser(description="Build the slim station catalog the app loads.")
+    parser.add_argument("--source", default=STATIONS_JSON, help="full StopPoint JSON (fetched from TfL if missing)")
+    parser.add_argument("--out", default=STATIONS_CATALOG)
+    args = parser.parse_args()
 
-    print(names)
+    if os.path.exists(args.source):
+        records = _station_records(json.load(open(args.source, 'r')))
+    else:
+        records = _station_records(_refresh_cache())
+        json.dump(records, open(args.source, 'w'))
 
-    json.dump(_STATIONS, open('data/stations_naptan.json', 'w'))
+    n = build_station_catalog(records, args.out)
+    print(f"{args.out}: {n} stop points, {os.path.getsize(args.out) / 1024:.1f} KiB")
@@ -0,0 +1,138 @@
+import os
+
+import re
+
+import json
+
+from datetime import datetime, timezone
+
+import numpy as np
+
+# One fixed-width, little-endian row per live observation:
+# time (unix seconds, UTC), percentageOfBaseline, NaPTAN id (ASCII, NUL-padded).
+ROW = np.dtype([("time", "<i8"), ("value", "<f4"), ("naptan", "S12")])
+
+_DAY_FILE = re.compile(r"^crowding-(\d{8})\.bin$")
+
+def _parse_time(time_utc):
+    """Unix seconds of a TfL `timeUtc` string such as '2025-07-14T09:30:00Z'."""
+    return int(datetime.fromisoformat(time_utc.replace("Z", "+00:00")).timestamp())
+
+def _day(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime("%Y%m%d")
+
+class CrowdingLog:
+    """
+    Append-only log of live crowding payloads in `directory`, one file of
+    ROW records per UTC day (`crowding-YYYYMMDD.bin`, no header).
+
+    Each batch is written with a single O_APPEND write, so several workers
+    can share the directory; readers memory-map the files and ignore a
+    trailing partial row. Only payloads with data are recorded, stamped with
+    their `timeUtc` (or the time of recording when it is missing).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, day):
+        return os.path.join(self.directory, f"crowding-{day}.bin")
+
+    def append(self, payloads, now=None):
+        """Record {naptan: payload}. Returns the number of rows written."""
+
+        now = int(now if now is not None else datetime.now(timezone.utc).timestamp())
+        rows = []
+        for naptan, payload in payloads.items():
+            if not payload.get("dataAvailable") or "percentageOfBaseline" not in payload:
+                continue
+            try:
+                t = _parse_time(payload["timeUtc"]) if payload.get("timeUtc") else now
+            except ValueError:
+                t = now
+            rows.append((t, payload["percentageOfBaseline"], naptan.encode("ascii")))
+
+        if not rows:
+            return 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        rows = np.array(rows, dtype=ROW)
+        days = np.array([_day(t) for t in rows["time"]])
+        for day in np.unique(days):
+            fd = os.open(self.path(day), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, rows[days == day].tobytes())
+            finally:
+                os.close(fd)
+        return len(rows)
+
+    def record(self, naptan, payload):
+        return self.append({naptan: payload})
+
+    def days(self):
+        """Recorded days ('YYYYMMDD'), oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(m.group(1) for m in map(_DAY_FILE.match, os.listdir(self.directory)) if m)
+
+    def open_day(self, day):
+        """Read-only memory map of one day's rows."""
+
+        path = self.path(day)
+        n = os.path.getsize(path) // ROW.itemsize
+        if n == 0:
+            return np.empty(0, dtype=ROW)
+        return np.memmap(path, dtype=ROW, mode="r", shape=(n,))
+
+    def read(self, start=None, end=None, stations=None, dedupe=True):
+        """
+        All rows with `start` <= time < `end` (unix seconds, either may be
+        None), optionally only for the NaPTAN ids in `stations`, as one ROW
+        array sorted by time. With `dedupe`, rows recorded by more than one
+        worker for the same station and time are kept once.
+        """
+
+        first = _day(start) if start is not None else None
+        last = _day(end) if end is not None else None
+
+        parts = []
+        for day in self.days():
+            if (first and day < first) or (last and day > last):
+                continue
+            rows = self.open_day(day)
+            mask = np.ones(len(rows), dtype=bool)
+            if start is not None:
+                mask &= rows["time"] >= start
+            if end is not None:
+                mask &= rows["time"] < end
+            if stations is not None:
+                mask &= np.isin(rows["naptan"], np.array([s.encode("ascii") for s in stations], dtype="S12"))
+            parts.append(np.array(rows[mask]))
+
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=ROW)
+        if dedupe and len(rows):
+            _, keep = np.unique(rows[["naptan", "time"]], return_index=True)
+            rows = rows[keep]
+        return rows[np.argsort(rows["time"], kind="stable")]
+
+def station_series(rows):
+    """Split rows into {naptan: (times, values)}."""
+
+    out = {}
+    for naptan in np.unique(rows["naptan"]):
+        sel = rows[rows["naptan"] == naptan]
+        out[naptan.decode("ascii")] = (sel["time"], sel["value"])
+    return out
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise a live crowding log: per-station maximum and mean of percentageOfBaseline.")
+    parser.add_argument("directory", nargs="?", default=os.getenv("CROWDING_LOG_DIR", "crowding_log"))
+    args = parser.parse_args()
+
+    log = CrowdingLog(args.directory)
+    rows = log.read()
+    summary = {naptan: {"max": float(v.max()), "mean": float(v.mean()), "n": len(v)} for naptan, (_, v) in station_series(rows).items()}
+    print(json.dumps(summary, indent=2, sort_keys=True))
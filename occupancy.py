@@ -1,19 +1,26 @@
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 
 from scipy.stats import truncnorm
 
 import numpy as np
 
-import h5py
-
-import os
+import io
 
 import json
 
 from datetime import datetime, timedelta
 
-import re
+import threading
+
+from functools import cache
+
+import render
+
+from routes import line_positions, line_stations, route_index
+
+from overlay_cache import overlay_key
+
+from timings import stage
 
 from PIL import Image
 from matplotlib.colors import Normalize
@@ -23,6 +30,8 @@ from scipy.stats import gaussian_kde
 from matplotlib.colors import LinearSegmentedColormap
 
 from matplotlib import rcParams
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 mpl.use("Agg")
 
@@ -35,7 +44,7 @@ rcParams["axes.linewidth"] = 2.0
 
 rcParams.update({"figure.autolayout": True})
 
-plt.rcParams["figure.figsize"] = (6, 6)
+rcParams["figure.figsize"] = (6, 6)
 
 LONDON_UNDERGROUND_COLORS = {
     "Bakerloo": "#B36305",
@@ -52,9 +61,6 @@ LONDON_UNDERGROUND_COLORS = {
     "Elizabeth": "#A0A5A9",
 }
 
-def _sanitize_station_name(s):
-    return re.sub(r"[^A-Za-z0-9]+", "_", s).strip("_")
-
 def _round_to_half_hour(tstr):
     t = datetime.strptime(tstr, "%H:%M")
     m = (t.minute + 15) // 30 * 30
@@ -71,6 +77,33 @@ def _truncnorm_row(bin_centers, mean, std):
     s = vals.sum()
     return vals / s if s > 0 else vals
 
+def _bin_centers(bins):
+    xs = np.linspace(0, 100, bins + 1)
+    return 0.5 * (xs[:-1] + xs[1:])
+
+@cache
+def kernel_matrix(line_key, direction, std, bins):
+    """
+    Return K where K[i] == _truncnorm_row(centers, pos, std) for the i-th
+    station of `line_stations(line_key)`. Built once per (line, direction, std, bins).
+    """
+
+    stations_pos = line_positions(line_key)
+    pos_idx = 1 if direction in ("WB", "SB") else 0
+
+    names = line_stations(line_key)
+    means = np.array([stations_pos[s][pos_idx] for s in names], dtype=float)[:, None]
+    centers = _bin_centers(bins)[None, :]
+
+    a = (0 - means) / std
+    b = (100 - means) / std
+    vals = truncnorm.pdf(centers, a, b, loc=means, scale=std)
+    sums = vals.sum(axis=1, keepdims=True)
+    K = np.divide(vals, sums, out=vals.copy(), where=sums > 0)
+    K.flags.writeable = False
+
+    return K
+
 def hex_to_colormap(hex_color, name="custom_colormap", n=256):
     """
     Creates a linear segmented colormap from a single hex color.
@@ -101,40 +134,74 @@ def live_relative_crowding(station, maxima_dict, crowding_api):
 
     return crowding_api(station)
 
-def generate_live_overlay(current_time, station, direction, hdf5_dir, maxima_json, out_png, crowding_api, bins=200, std=30, overlay_path="assets/trainsparency.png", line_key="Piccadilly"):
+def live_relative_crowding_many(stations, maxima_dict, crowding_api):
+    """Crowding for several stations, in one batch if `crowding_api.many` exists."""
+
+    batch = getattr(crowding_api, "many", None)
+    if batch is not None:
+        return batch(list(stations))
+
+    return [live_relative_crowding(s, maxima_dict, crowding_api) for s in stations]
+
+# Live weights are rounded to this step before mixing, so that overlays can be
+# cached by their (quantized) inputs.
+WEIGHT_QUANTUM = 0.01
+
+def _slot_routes(current_time, station, direction, hdf5_dir, line_key):
     tkey = _round_to_half_hour(current_time).replace(":", "")
-    fn = os.path.join(hdf5_dir, f"{_sanitize_station_name(station)}.h5")
-    maxima = json.load(open(maxima_json, "rb"))
-    line_entrances = json.load(open("data/line_entrances.json", "rb"))
-    stations_pos = dict(line_entrances[line_key][0], **line_entrances[line_key][1])
-    pos_idx = 1 if direction in ("WB", "SB") else 0
+    index = route_index(hdf5_dir, line_key)
+    upstream_routes, n_routes = index.routes(station, direction, tkey)
+    return tkey, index, upstream_routes, n_routes
 
-    xs = np.linspace(0, 100, bins + 1)
-    centers = 0.5 * (xs[:-1] + xs[1:])
-    mix_total = np.zeros_like(centers, dtype=float)
+def slot_weights(index, upstream_routes, maxima, crowding_api, quantum=None):
+    """Live weight of every upstream station of a slot, as a dense vector over station IDs."""
+
+    weights = np.zeros(len(index.stations), dtype=float)
+    if upstream_routes:
+        ids = np.unique(np.concatenate(upstream_routes))
+        weights[ids] = live_relative_crowding_many(index.stations[ids], maxima, crowding_api)
 
-    with h5py.File(fn, "r") as h5:
-        routes_grp = h5[direction][tkey]["routes"]
-        n_routes = len(routes_grp.keys())
-        for key in sorted(routes_grp.keys(), key=lambda s: int(s[1:])):
-            g = routes_grp[key]
-            full_path = [s for s in g["stations"][...].astype(str)]
-            pivot_idx = int(g.attrs["pivot_idx"])
-            upstream = full_path[:pivot_idx + 1]
+    if quantum:
+        weights = np.rint(weights / quantum) * quantum
 
-            ws = np.array([live_relative_crowding(s, maxima, crowding_api) for s in upstream], dtype=float)
-            sw = ws.sum()
-            ws = ws / sw if sw > 0 else np.ones(len(upstream), dtype=float) / max(1, len(upstream))
+    return weights
 
-            mix_route = np.zeros_like(centers, dtype=float)
-            for s, w in zip(upstream, ws):
-                m = stations_pos[s][pos_idx]
-                mix_route += w * _truncnorm_row(centers, m, std)
+def _mixture(upstream_routes, n_routes, weights, K):
+    mix_total = np.zeros(K.shape[1], dtype=float)
 
-            mix_total += mix_route
+    for ids in upstream_routes:
+        ws = weights[ids]
+        sw = ws.sum()
+        ws = ws / sw if sw > 0 else np.ones(len(ids), dtype=float) / max(1, len(ids))
+
+        mix_total += ws @ K[ids]
 
     mix_total /= max(1, n_routes)
 
+    return mix_total
+
+def route_mixture(current_time, station, direction, hdf5_dir, maxima_json, crowding_api, bins=200, std=30, line_key="Piccadilly", quantum=None):
+    maxima = json.load(open(maxima_json, "rb"))
+    tkey, index, upstream_routes, n_routes = _slot_routes(current_time, station, direction, hdf5_dir, line_key)
+    weights = slot_weights(index, upstream_routes, maxima, crowding_api, quantum=quantum)
+
+    mix_total = _mixture(upstream_routes, n_routes, weights, kernel_matrix(line_key, direction, std, bins))
+
+    return _bin_centers(bins), mix_total
+
+def line_color(line_key):
+    return LONDON_UNDERGROUND_COLORS.get(line_key, "#003688")
+
+@cache
+def _line_colormap(line_key):
+    return hex_to_colormap(line_color(line_key))
+
+# Figures are reused per thread: building one costs more than drawing it, and
+# pyplot's global figure manager is neither thread-safe nor ever closed here.
+_FIGURE_POOL = threading.local()
+
+def _build_figure(centers, overlay_path):
+
     overlay_img = Image.open(overlay_path).convert("RGBA")
     img_w, img_h = overlay_img.size
     aspect = img_w / img_h
@@ -144,14 +211,12 @@ def generate_live_overlay(current_time, station, direction, hdf5_dir, maxima_jso
     fig_w = fig_h * aspect
     dpi = 70
 
-    fig, ax = plt.subplots(figsize=(fig_w, fig_h), dpi=dpi)
-
-    norm = Normalize(vmin=mix_total.min(), vmax=mix_total.max())
-    cmap = hex_to_colormap(LONDON_UNDERGROUND_COLORS.get(line_key, "#003688"))
-    colors = cmap(norm(mix_total))
+    fig = Figure(figsize=(fig_w, fig_h), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
     bin_w = centers[1] - centers[0]
-    ax.bar(centers, np.ones_like(centers), width=bin_w, color=colors, edgecolor="none", zorder=1)
+    bars = ax.bar(centers, np.ones_like(centers), width=bin_w, color="white", edgecolor="none", zorder=1)
 
     ax.set_xticks([])
     ax.set_yticks([])
@@ -164,8 +229,113 @@ def generate_live_overlay(current_time, station, direction, hdf5_dir, maxima_jso
     extent = [0, 100, 0, 1]
     ax.imshow(overlay_np, extent=extent, aspect="auto", zorder=10, alpha=1.0, interpolation="bilinear")
 
-    plt.tight_layout()
-    fig.savefig(out_png, dpi=dpi, bbox_inches="tight", transparent=True)
+    fig.tight_layout()
+
+    return fig, bars
+
+def _pooled_figure(centers, overlay_path):
+    pool = getattr(_FIGURE_POOL, "figures", None)
+    if pool is None:
+        pool = _FIGURE_POOL.figures = {}
+
+    key = (overlay_path, len(centers))
+    if key not in pool:
+        pool[key] = _build_figure(centers, overlay_path)
+    return pool[key]
+
+def _render_matplotlib(centers, mix_total, out_png, overlay_path, line_key, timings=None):
+
+    # savefig draws and encodes in one go, so it is all timed as "raster"
+    with stage(timings, "raster"):
+        fig, bars = _pooled_figure(centers, overlay_path)
+
+        norm = Normalize(vmin=mix_total.min(), vmax=mix_total.max())
+        colors = _line_colormap(line_key)(norm(mix_total))
+
+        for bar, color in zip(bars, colors):
+            bar.set_facecolor(color)
+
+        fig.savefig(out_png, dpi=fig.dpi, bbox_inches="tight", transparent=True)
+
+def _render_numpy(centers, mix_total, out_png, overlay_path, line_key, timings=None):
+    with stage(timings, "raster"):
+        img = render.render_strip(mix_total, line_color(line_key), overlay_path)
+    with stage(timings, "encode"):
+        render.encode_png(img, out_png)
+
+RENDERERS = {
+    "numpy": _render_numpy,
+    "matplotlib": _render_matplotlib,
+}
+
+def live_overlay(current_time, station, direction, hdf5_dir, maxima_json, crowding_api, bins=200, std=30, overlay_path="assets/trainsparency.png", line_key="Piccadilly", renderer="numpy", cache=None, quantum=WEIGHT_QUANTUM, timings=None):
+    """
+    Return (key, PNG bytes) of the crowding overlay for `station` at `current_time`.
+
+    `key` is the content key of the render inputs (slot, quantized live weights,
+    bins, std, ...). With an `OverlayCache`, a known key is served from the cache
+    and only new inputs are mixed and rendered. A `timings.Timings` records
+    the time spent in each stage.
+    """
+
+    with stage(timings, "routes"):
+        maxima = json.load(open(maxima_json, "rb"))
+        tkey, index, upstream_routes, n_routes = _slot_routes(current_time, station, direction, hdf5_dir, line_key)
+    with stage(timings, "fetch"):
+        weights = slot_weights(index, upstream_routes, maxima, crowding_api, quantum=quantum)
+
+    key = overlay_key(station, direction, tkey, weights, bins, std, line=line_key, renderer=renderer, overlay=overlay_path)
+    data = cache.get(key) if cache is not None else None
+    if timings is not None and cache is not None:
+        timings.note("overlay", "hit" if data is not None else "miss")
+    if data is not None:
+        return key, data
+
+    with stage(timings, "mixture"):
+        mix_total = _mixture(upstream_routes, n_routes, weights, kernel_matrix(line_key, direction, std, bins))
+
+    buf = io.BytesIO()
+    RENDERERS[renderer](_bin_centers(bins), mix_total, buf, overlay_path, line_key, timings=timings)
+    data = buf.getvalue()
+
+    if cache is not None:
+        with stage(timings, "write"):
+            cache.put(key, data)
+
+    return key, data
+
+def live_profile(current_time, station, direction, hdf5_dir, maxima_json, crowding_api, bins=200, std=30, line_key="Piccadilly", quantum=WEIGHT_QUANTUM, timings=None):
+    """
+    Return (key, levels): the crowding mixture as uint8 colormap levels, the
+    per-bin LUT indices the renderers use, for drawing the strip client-side.
+    """
+
+    with stage(timings, "routes"):
+        maxima = json.load(open(maxima_json, "rb"))
+        tkey, index, upstream_routes, n_routes = _slot_routes(current_time, station, direction, hdf5_dir, line_key)
+    with stage(timings, "fetch"):
+        weights = slot_weights(index, upstream_routes, maxima, crowding_api, quantum=quantum)
+
+    key = overlay_key(station, direction, tkey, weights, bins, std, line=line_key)
+    with stage(timings, "mixture"):
+        mix_total = _mixture(upstream_routes, n_routes, weights, kernel_matrix(line_key, direction, std, bins))
+
+    return key, render.profile_levels(mix_total)
+
+def generate_live_overlay(current_time, station, direction, hdf5_dir, maxima_json, out_png, crowding_api, bins=200, std=30, overlay_path="assets/trainsparency.png", line_key="Piccadilly", renderer="numpy", cache=None):
+    """
+    Render the expected crowding along the train for `station` at `current_time` to `out_png`.
+
+    `renderer` selects the backend: "numpy" builds the strip directly with NumPy/Pillow,
+    "matplotlib" is the original figure-based renderer, kept as a fallback.
+    Returns the overlay's content key.
+    """
+
+    key, data = live_overlay(current_time, station, direction, hdf5_dir, maxima_json, crowding_api, bins=bins, std=std, overlay_path=overlay_path, line_key=line_key, renderer=renderer, cache=cache)
+
+    render.write_png(data, out_png)
+
+    return key
 
 if __name__ == "__main__":
 
@@ -0,0 +1,175 @@
+import os
+
+import time
+
+import hashlib
+
+import threading
+
+import numpy as np
+
+from cachetools import LRUCache
+
+def overlay_key(station, direction, tkey, weights, bins, std, **extra):
+    """
+    Content key of an overlay: everything the rendered image depends on.
+
+    `weights` must already be quantized (see occupancy.WEIGHT_QUANTUM) so that
+    equal keys really mean equal images. Any `extra` settings (line, renderer,
+    overlay image, ...) are folded in as well.
+    """
+
+    h = hashlib.sha1()
+    parts = [station, direction, tkey, bins, std] + [f"{k}={extra[k]}" for k in sorted(extra)]
+    h.update("|".join(str(p) for p in parts).encode("utf-8"))
+    h.update(np.ascontiguousarray(weights, dtype="<f8").tobytes())
+    return h.hexdigest()
+
+class ImageDirectory:
+    """
+    Bounded directory of `<key>.png` files.
+
+    Writes go to a temporary file and are renamed into place, so readers (and
+    the static file server) never see a partial image. Reads bump the file's
+    mtime, which makes eviction least-recently-used across every worker sharing
+    the directory. When the byte or file cap is exceeded, or on startup, the
+    directory is rescanned and the oldest files are removed until it is back
+    under `low_water` of both caps. Files older than `max_age` seconds, if set,
+    are removed too.
+    """
+
+    TMP_SUFFIX = ".tmp"
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_files=2000, max_age=None, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.low_water = low_water
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._files = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.cleanup()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def read(self, key):
+        try:
+            with open(self.path(key), "rb") as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        self.touch(key)
+        return data
+
+    def touch(self, key):
+        """Mark `key` as recently used. False if its file is gone."""
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def write(self, key, data):
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}{self.TMP_SUFFIX}"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._bytes += len(data)
+            self._files += 1
+            full = self._bytes > self.max_bytes or self._files > self.max_files
+
+        if full:
+            self.cleanup()
+
+    def cleanup(self):
+        """Drop stale temporary files and expired entries, then evict down to the low-water mark."""
+
+        now = time.time()
+        entries = []
+        with os.scandir(self.directory) as it:
+            for e in it:
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                if e.name.endswith(self.TMP_SUFFIX):
+                    # another worker may still be writing a fresh one
+                    if now - st.st_mtime > 60:
+                        self._remove(e.path)
+                elif e.name.endswith(".png"):
+                    entries.append((st.st_mtime, st.st_size, e.path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        max_bytes = self.max_bytes * self.low_water
+        max_files = self.max_files * self.low_water
+
+        for mtime, size, path in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            if not (expired or total > max_bytes or count > max_files):
+                break
+            if self._remove(path):
+                self.evictions += 1
+            total -= size
+            count -= 1
+
+        with self._lock:
+            self._bytes = total
+            self._files = count
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+class OverlayCache:
+    """
+    Rendered overlay PNGs by content key, in an in-memory LRU (bounded by
+    total bytes) backed by an optional ImageDirectory that survives restarts
+    and is shared by all workers.
+    """
+
+    def __init__(self, directory=None, max_bytes=32 * 1024 * 1024, **disk_limits):
+        # max_bytes bounds the memory tier, disk_limits are passed to ImageDirectory
+        self.disk = ImageDirectory(directory, **disk_limits) if directory else None
+        self._memory = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+
+        if data is not None or self.disk is None:
+            return data
+
+        data = self.disk.read(key)
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+
+        if self.disk is not None:
+            self.disk.write(key, data)
+
+    def _remember(self, key, data):
+        with self._lock:
+            try:
+                self._memory[key] = data
+            except ValueError:
+                # larger than the whole memory tier
+                pass
@@ -0,0 +1,140 @@
+import io
+import math
+
+from functools import cache
+
+import numpy as np
+
+from PIL import Image
+
+# Layout constants matching the matplotlib renderer in occupancy.py:
+# tight_layout pads by 1.08 * the default 10pt font, savefig(bbox_inches="tight")
+# then crops to the axes plus 0.1in.
+TIGHT_PAD_IN = 1.08 * 10 / 72
+SAVE_PAD_IN = 0.1
+
+def hex_to_lut(hex_color, n=256):
+    """
+    Build the uint8 RGBA lookup table of a white -> hex_color colormap.
+
+    Same values as `occupancy.hex_to_colormap(hex_color, n=n)`, rounded the way
+    Agg rounds float colours, without importing matplotlib.
+    """
+
+    hex_color = hex_color.lstrip("#")
+    rgb = np.array([int(hex_color[i : i + 2], 16) / 255.0 for i in (0, 2, 4)])
+
+    x = np.linspace(0, 1, n)[:, None]
+    lut = np.ones((n, 4))
+    lut[:, :3] = 1 + (rgb - 1) * x
+
+    return np.rint(lut * 255).astype(np.uint8)
+
+def _lut_index(values, n):
+    """Normalize to [0, 1] and map to LUT indices like Normalize + Colormap."""
+
+    values = np.asarray(values, dtype=float)
+    vmin, vmax = values.min(), values.max()
+    if vmin == vmax:
+        return np.zeros(len(values), dtype=int)
+
+    x = (values - vmin) / (vmax - vmin) * n
+    return np.clip(x.astype(int), 0, n - 1)
+
+def profile_levels(values):
+    """Per-bin colormap level (0-255) of a mixture, for drawing the strip elsewhere."""
+    return _lut_index(values, 256).astype(np.uint8)
+
+class StripLayout:
+    """Pixel geometry of the rendered strip for a given overlay image size."""
+
+    def __init__(self, overlay_size, dpi=70, fig_h=6):
+        img_w, img_h = overlay_size
+        fig_w = fig_h * img_w / img_h
+
+        tight_pad = TIGHT_PAD_IN * dpi
+        save_pad = SAVE_PAD_IN * dpi
+
+        # axes size in pixels and the cropped canvas around it
+        self.axes_w = fig_w * dpi - 2 * tight_pad
+        self.axes_h = fig_h * dpi - 2 * tight_pad
+        self.width = int((fig_w - 2 * TIGHT_PAD_IN + 2 * SAVE_PAD_IN) * dpi)
+        self.height = int((fig_h - 2 * TIGHT_PAD_IN + 2 * SAVE_PAD_IN) * dpi)
+
+        # Agg snaps the rectilinear bars to whole pixels
+        self.pad = save_pad
+        self.x0 = math.floor(save_pad + 0.5)
+        self.x1 = math.floor(save_pad + self.axes_w + 0.5)
+        self.y0 = self.height - math.floor(save_pad + self.axes_h + 0.5)
+        self.y1 = self.height - math.floor(save_pad + 0.5)
+
+    def bar_edges(self, bins):
+        xs = self.pad + np.arange(bins + 1) * self.axes_w / bins
+        return np.floor(xs + 0.5).astype(int)
+
+@cache
+def _scaled_overlay(overlay_path, dpi=70, fig_h=6):
+    """Load the train overlay and bilinearly resample it onto the axes area once."""
+
+    overlay = Image.open(overlay_path).convert("RGBA")
+    layout = StripLayout(overlay.size, dpi=dpi, fig_h=fig_h)
+
+    out_w = math.ceil(layout.axes_w)
+    out_h = math.ceil(layout.axes_h)
+
+    # imshow maps the image onto the fractional axes size, so sample the exact
+    # source span; pad by one edge pixel so the box may reach past the border
+    img_w, img_h = overlay.size
+    padded = Image.fromarray(np.pad(np.asarray(overlay), ((0, 1), (0, 1), (0, 0)), mode="edge"))
+    box = (0, 0, img_w * out_w / layout.axes_w, img_h * out_h / layout.axes_h)
+    scaled = padded.resize((out_w, out_h), Image.BILINEAR, box=box)
+
+    placed = Image.new("RGBA", (layout.width, layout.height), (0, 0, 0, 0))
+    placed.paste(scaled, (round(layout.pad), round(layout.pad)))
+
+    # imshow is clipped to the axes, which is exactly the span of the bars
+    return layout, placed.crop((layout.x0, layout.y0, layout.x1, layout.y1))
+
+def render_strip(mix_total, line_color, overlay_path="assets/trainsparency.png", dpi=70, fig_h=6):
+    """
+    Render the crowding gradient under the train overlay as a PIL RGBA image.
+
+    Pixel-equivalent (to within a few levels of bilinear rounding) to the
+    matplotlib renderer in `occupancy.generate_live_overlay`.
+    """
+
+    layout, overlay = _scaled_overlay(overlay_path, dpi, fig_h)
+
+    lut = hex_to_lut(line_color)
+    colors = lut[_lut_index(mix_total, len(lut))]
+
+    edges = layout.bar_edges(len(colors))
+
+    strip = np.empty((layout.y1 - layout.y0, layout.x1 - layout.x0, 4), dtype=np.uint8)
+    strip[...] = np.repeat(colors, np.diff(edges), axis=0)
+
+    img = Image.new("RGBA", (layout.width, layout.height), (255, 255, 255, 0))
+    img.paste(Image.alpha_composite(Image.fromarray(strip), overlay), (layout.x0, layout.y0))
+
+    return img
+
+def write_png(data, out_png):
+    """Write PNG bytes to `out_png`, a path or a file object."""
+
+    if hasattr(out_png, "write"):
+        out_png.write(data)
+    else:
+        with open(out_png, "wb") as fh:
+            fh.write(data)
+
+def encode_png(img, out_png=None):
+    """Encode to PNG, writing to `out_png` (path or file object) if given. Returns the bytes."""
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    data = buf.getvalue()
+
+    if out_png is not None:
+        write_png(data, out_png)
+
+    return data
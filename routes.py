@@ -0,0 +1,243 @@
+import os
+
+import json
+
+import logging
+
+import re
+
+import threading
+
+from functools import cache
+
+import numpy as np
+
+import h5py
+
+logger = logging.getLogger(__name__)
+
+def _sanitize_station_name(s):
+    return re.sub(r"[^A-Za-z0-9]+", "_", s).strip("_")
+
+@cache
+def line_positions(line_key, entrances_json="data/line_entrances.json"):
+    """Return {station: [EB position, WB position]} along the train for a line."""
+    line_entrances = json.load(open(entrances_json, "rb"))
+    return dict(line_entrances[line_key][0], **line_entrances[line_key][1])
+
+@cache
+def line_stations(line_key):
+    """Stations of a line in a fixed order; a station's ID is its position here."""
+    return tuple(sorted(line_positions(line_key)))
+
+class RouteIndex:
+    """
+    In-memory index of the per-station route files in `hdf5_dir`.
+
+    Maps (station, direction, half-hour slot key) to the upstream part of each
+    route as an array of station IDs (positions in `line_stations(line_key)`,
+    which are also the rows of `occupancy.kernel_matrix`) and the route count.
+    A station's file is read once, on first use or by `preload`; lookups never
+    touch h5py afterwards.
+    """
+
+    def __init__(self, hdf5_dir, line_key="Piccadilly"):
+        self.hdf5_dir = hdf5_dir
+        self.line_key = line_key
+        self.stations = np.array(line_stations(line_key))
+        self._ids = {s: i for i, s in enumerate(self.stations)}
+        self._slots = {}
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+    def _read_station(self, station):
+        fn = os.path.join(self.hdf5_dir, f"{_sanitize_station_name(station)}.h5")
+
+        slots = {}
+        with h5py.File(fn, "r") as h5:
+            for direction in h5.keys():
+                for tkey, slot in h5[direction].items():
+                    routes_grp = slot["routes"]
+                    upstream = []
+                    for key in sorted(routes_grp.keys(), key=lambda s: int(s[1:])):
+                        g = routes_grp[key]
+                        pivot_idx = int(g.attrs["pivot_idx"])
+                        full_path = g["stations"][: pivot_idx + 1].astype(str)
+                        upstream.append(np.array([self._ids[s] for s in full_path], dtype=np.int16))
+                    slots[(station, direction, tkey)] = (tuple(upstream), len(routes_grp))
+        return slots
+
+    def _ensure(self, station):
+        if station in self._loaded:
+            return
+        with self._lock:
+            if station in self._loaded:
+                return
+            self._slots.update(self._read_station(station))
+            self._loaded.add(station)
+
+    def routes(self, station, direction, tkey):
+        """Return (upstream ID arrays, number of routes) for one slot."""
+        self._ensure(station)
+        return self._slots[(station, direction, tkey)]
+
+    def preload(self):
+        """Read every station file in `hdf5_dir` that belongs to the line."""
+        for station in self.stations:
+            if os.path.exists(os.path.join(self.hdf5_dir, f"{_sanitize_station_name(station)}.h5")):
+                self._ensure(station)
+
+STORE_MAGIC = b"ROUTES01"
+STORE_ALIGN = 64
+
+def store_path(data_dir, line_key="Piccadilly"):
+    return os.path.join(data_dir, f"{_sanitize_station_name(line_key)}_routes.bin")
+
+def _align(n):
+    return -(-n // STORE_ALIGN) * STORE_ALIGN
+
+def pack_store(index, out_path):
+    """
+    Write every slot of `index` (a preloaded RouteIndex) into one flat file.
+
+    Layout: magic, uint64 header length, JSON header, then 64-byte aligned
+    little-endian arrays:
+
+    * route_ids     int16   upstream station IDs of every distinct route, concatenated
+    * route_offsets int32   start of route r in route_ids (len = n_routes + 1)
+    * slot_routes   int32   route numbers of every slot, concatenated
+    * slot_offsets  int32   start of slot i in slot_routes (len = n_slots + 1)
+
+    The header maps "station/direction/tkey" to the slot number i.
+    """
+
+    index.preload()
+
+    routes = {}
+    slot_keys = {}
+    slot_routes = []
+    slot_offsets = [0]
+    for i, ((station, direction, tkey), (upstream, n_routes)) in enumerate(sorted(index._slots.items())):
+        assert n_routes == len(upstream)
+        for ids in upstream:
+            slot_routes.append(routes.setdefault(ids.tobytes(), len(routes)))
+        slot_offsets.append(len(slot_routes))
+        slot_keys[f"{station}/{direction}/{tkey}"] = i
+
+    unique = [np.frombuffer(b, dtype=np.int16) for b in routes]
+    arrays = {
+        "route_ids": np.concatenate(unique).astype("<i2"),
+        "route_offsets": np.cumsum([0] + [len(r) for r in unique]).astype("<i4"),
+        "slot_routes": np.array(slot_routes, dtype="<i4"),
+        "slot_offsets": np.array(slot_offsets, dtype="<i4"),
+    }
+
+    header = {
+        "line": index.line_key,
+        "stations": [str(s) for s in index.stations],
+        "slots": slot_keys,
+        "arrays": {},
+    }
+
+    # offsets depend on the header size, so size the header with placeholders first
+    for name, arr in arrays.items():
+        header["arrays"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": 0}
+    base = _align(len(STORE_MAGIC) + 8 + len(json.dumps(header).encode()) + 32 * len(arrays))
+
+    offset = base
+    for name, arr in arrays.items():
+        header["arrays"][name]["offset"] = offset
+        offset = _align(offset + arr.nbytes)
+
+    blob = json.dumps(header).encode()
+    assert len(STORE_MAGIC) + 8 + len(blob) <= base
+
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(STORE_MAGIC)
+        fh.write(np.uint64(len(blob)).tobytes())
+        fh.write(blob)
+        for name, arr in arrays.items():
+            fh.seek(header["arrays"][name]["offset"])
+            fh.write(arr.tobytes())
+        fh.truncate(offset)
+    os.replace(tmp, out_path)
+
+    return header
+
+class RouteStore:
+    """
+    Read-only view of a file written by `pack_store`, memory-mapped so the pages
+    are shared by every worker process. Same interface as RouteIndex.
+    Raises ValueError if the file isn't a store, or if its station IDs no
+    longer match `line_stations` (the line changed since it was packed).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._buf = np.memmap(path, dtype=np.uint8, mode="r")
+
+        if bytes(self._buf[: len(STORE_MAGIC)]) != STORE_MAGIC:
+            raise ValueError(f"{path} is not a route store")
+        n = int(self._buf[len(STORE_MAGIC) : len(STORE_MAGIC) + 8].view("<u8")[0])
+        start = len(STORE_MAGIC) + 8
+        header = json.loads(bytes(self._buf[start : start + n]))
+
+        self.line_key = header["line"]
+        if header["stations"] != list(line_stations(self.line_key)):
+            raise ValueError(f"{path} is out of date: its stations differ from line_stations({self.line_key!r})")
+        self.stations = np.array(header["stations"])
+        self._slots = header["slots"]
+
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"]))
+            arr = self._buf[spec["offset"] : spec["offset"] + count * dtype.itemsize].view(dtype)
+            setattr(self, name, arr.reshape(spec["shape"]))
+
+    def routes(self, station, direction, tkey):
+        """Return (upstream ID arrays, number of routes) for one slot."""
+        i = self._slots[f"{station}/{direction}/{tkey}"]
+        rs = self.slot_routes[self.slot_offsets[i] : self.slot_offsets[i + 1]]
+        upstream = tuple(self.route_ids[self.route_offsets[r] : self.route_offsets[r + 1]] for r in rs)
+        return upstream, len(upstream)
+
+    def preload(self):
+        """Nothing to read up front; the OS pages the store in on demand."""
+
+@cache
+def route_index(data_dir, line_key="Piccadilly"):
+    """Use the packed route store when present and valid, otherwise index the .h5 files."""
+
+    path = store_path(data_dir, line_key)
+    if os.path.exists(path):
+        try:
+            return RouteStore(path)
+        except ValueError as e:
+            logger.warning("Not using the route store: %s", e)
+    return RouteIndex(data_dir, line_key)
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack the per-station HDF5 route files into one memory-mappable store.")
+    parser.add_argument("--hdf5-dir", default="data")
+    parser.add_argument("--line", default="Piccadilly")
+    parser.add_argument("--out", default=None, help="defaults to <hdf5-dir>/<line>_routes.bin")
+    parser.add_argument("--verify", action="store_true", help="check every slot of the store against the .h5 files")
+    args = parser.parse_args()
+
+    out = args.out or store_path(args.hdf5_dir, args.line)
+    index = RouteIndex(args.hdf5_dir, args.line)
+    header = pack_store(index, out)
+
+    print(f"{out}: {len(header['slots'])} slots, {header['arrays']['route_offsets']['shape'][0] - 1} distinct routes, "
+          f"{os.path.getsize(out) / 1024:.1f} KiB")
+
+    if args.verify:
+        store = RouteStore(out)
+        for (station, direction, tkey), (upstream, n_routes) in index._slots.items():
+            got, n = store.routes(station, direction, tkey)
+            assert n == n_routes and all(np.array_equal(a, b) for a, b in zip(got, upstream)), (station, direction, tkey)
+        print("verified")
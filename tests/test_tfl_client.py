@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from tfl_client import AsyncTfLClient, CircuitBreaker
+
+async def _failing_server(delay):
+    async def crowding(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"message": "down"}, status=503)
+
+    app = web.Application()
+    app.router.add_get("/crowding/{naptan}/Live", crowding)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+def test_concurrent_failures_trip_once():
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=5.0, max_reset_timeout=120.0)
+
+    async def run():
+        runner, url = await _failing_server(0.05)
+        client = AsyncTfLClient(url, limit=32, breaker=breaker, retries=0)
+        try:
+            return await asyncio.gather(*(client.live_crowding(f"940GZZLU{i:03d}") for i in range(32)), return_exceptions=True)
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(r, Exception) for r in results)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 1
+    assert breaker._open_until - time.monotonic() <= 5.0
+
+def test_only_the_probe_decides():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01, max_reset_timeout=0.01)
+
+    late = breaker.allow()
+    breaker.record(breaker.allow(), False, 0.0)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # a call from before the trip finishing while open changes nothing
+    breaker.record(late, False, 0.0)
+    assert breaker.trips == 1
+
+    time.sleep(0.02)
+    probe = breaker.allow()
+    assert probe is not None and breaker.allow() is None
+
+    # nor does one finishing mid-probe, successful or not
+    breaker.record(late, True, 0.0)
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.rejecting()
+
+    breaker.record(probe, True, 0.0)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.trips == 0
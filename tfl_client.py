@@ -0,0 +1,312 @@
+import asyncio
+
+import json
+
+import random
+
+import threading
+
+import time
+
+from concurrent.futures import Future
+
+from urllib.parse import quote
+
+import aiohttp
+
+TFL_BASE_URL = "https://api.tfl.gov.uk"
+
+class TfLError(Exception):
+    """
+    A TfL request failed: connection error, timeout or an error status.
+    `transient` errors (connection failures, 5xx, 429) may succeed if retried.
+    """
+
+    def __init__(self, message, status=None, transient=False):
+        super().__init__(message)
+        self.status = status
+        self.transient = transient
+
+class CircuitOpenError(TfLError):
+    """Not sent: the circuit breaker is open after repeated failures or slow responses."""
+
+def backoff(attempt, base, cap):
+    """Capped exponential backoff with jitter: between half and all of min(cap, base * 2**attempt)."""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing upstream.
+
+    Closed: calls go through; a failure, or a success slower than
+    `slow_call` seconds, counts against the upstream, and `failure_threshold`
+    of them in a row open the breaker. Open: calls are refused until the
+    backoff (`reset_timeout` doubling per consecutive trip, capped at
+    `max_reset_timeout`, jittered) has passed. Half-open: one probe call is
+    let through; it closes the breaker or reopens it for longer.
+
+    `allow` hands each call it lets through a token for `record`. Only calls
+    let through since the breaker last opened count, so calls still in
+    flight when it trips (or while it probes) can't trip it again or stand
+    in for the probe.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, slow_call=5.0, reset_timeout=5.0, max_reset_timeout=120.0):
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._open_until = 0.0
+        self._probing = False
+        # bumped each time the breaker opens; tokens from before are stale
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def rejecting(self):
+        """True while calls would be refused, without claiming the half-open probe."""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() < self._open_until or self._probing
+
+    def allow(self):
+        """
+        A token for `record` if a call may go ahead now, else None. The first
+        call after the backoff becomes the probe.
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self._open_until:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return (self.CLOSED, self._epoch)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return (self.HALF_OPEN, self._epoch)
+            self.rejected += 1
+            return None
+
+    def record(self, token, ok, elapsed):
+        """Report the outcome of a call `allow` let through with `token`."""
+        healthy = ok and elapsed <= self.slow_call
+        with self._lock:
+            state, epoch = token
+            if epoch != self._epoch or state != self.state:
+                # started before the breaker last opened, or a closed-state call ending mid-probe
+                return
+            if state == self.HALF_OPEN:
+                self._probing = False
+            if healthy:
+                self.failures = 0
+                if state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self.trips = 0
+                return
+            self.failures += 1
+            if state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.failures = 0
+                self._open_until = time.monotonic() + backoff(self.trips, self.reset_timeout, self.max_reset_timeout)
+                self.trips += 1
+                self._epoch += 1
+
+class AsyncTfLClient:
+    """
+    asyncio client for the TfL endpoints the app uses.
+
+    All requests share one aiohttp session whose connection pool holds at most
+    `limit` connections, so any number of concurrent fetches reuse a bounded
+    set of keep-alive connections. `timeout` (seconds) applies to each request
+    unless a call passes its own, and starts once the request has a connection
+    slot, so queueing behind the pool doesn't count. `base_url` can point at a
+    local stub server.
+
+    Requests go through `breaker` (a CircuitBreaker) and raise
+    CircuitOpenError without being sent while it is open. Transient failures
+    other than timeouts are retried up to `retries` times after a `backoff`
+    of `retry_backoff` seconds doubling up to `max_retry_backoff`.
+    """
+
+    def __init__(self, base_url=TFL_BASE_URL, app_key=None, limit=32, timeout=30,
+                 breaker=None, retries=1, retry_backoff=0.2, max_retry_backoff=2.0):
+        self.base_url = base_url.rstrip("/")
+        self.app_key = app_key
+        self.limit = limit
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._session = None
+        self._slots = asyncio.Semaphore(limit)
+
+    def _get_session(self):
+        # created lazily: a session belongs to the event loop it was made on
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get_json(self, path, params=None, timeout=None):
+        """GET `path` and decode the JSON body. Raises TfLError, or ValueError for a bad body."""
+
+        params = dict(params or {})
+        if self.app_key:
+            params["app_key"] = self.app_key
+
+        kwargs = {"params": params}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        for attempt in range(self.retries + 1):
+            try:
+                return json.loads(await self._get(path, kwargs))
+            except CircuitOpenError:
+                raise
+            except TfLError as e:
+                if not e.transient or attempt == self.retries or self.breaker.rejecting():
+                    raise
+            await asyncio.sleep(backoff(attempt, self.retry_backoff, self.max_retry_backoff))
+
+    async def _get(self, path, kwargs):
+        async with self._slots:
+            token = self.breaker.allow()
+            if token is None:
+                raise CircuitOpenError(f"GET {path} not sent: circuit open")
+
+            ok = False
+            start = time.monotonic()
+            try:
+                async with self._get_session().get(self.base_url + path, **kwargs) as r:
+                    r.raise_for_status()
+                    body = await r.read()
+                ok = True
+            except aiohttp.ClientResponseError as e:
+                # a 4xx is an answer from a healthy upstream
+                server_error = e.status >= 500 or e.status == 429
+                ok = not server_error
+                raise TfLError(f"GET {path} failed: {e.status} {e.message}", e.status, transient=server_error) from e
+            except asyncio.TimeoutError as e:
+                raise TfLError(f"GET {path} failed: timed out") from e
+            except aiohttp.ClientError as e:
+                raise TfLError(f"GET {path} failed: {type(e).__name__} {e}", transient=True) from e
+            finally:
+                self.breaker.record(token, ok, time.monotonic() - start)
+
+        return body
+
+    async def live_crowding(self, naptan, timeout=None):
+        """/crowding/{naptan}/Live payload."""
+        data = await self.get_json(f"/crowding/{quote(naptan)}/Live", timeout=timeout)
+        if not isinstance(data, dict):
+            raise ValueError("Unexpected response format")
+        return data
+
+    async def search(self, name, modes="tube", timeout=None):
+        """/StopPoint/Search/{name} matches."""
+        data = await self.get_json(f"/StopPoint/Search/{quote(name)}", {"modes": modes}, timeout=timeout)
+        return data.get("matches", [])
+
+    async def stop_points(self, mode="tube", timeout=None, **params):
+        """/StopPoint/Mode/{mode}/ response."""
+        return await self.get_json(f"/StopPoint/Mode/{quote(mode)}/", params, timeout=timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+class TfLClient:
+    """
+    Blocking facade over AsyncTfLClient for threaded callers.
+
+    Requests run on one event loop in a daemon thread (started on first use),
+    so many concurrent fetches cost one thread and a bounded connection pool
+    rather than a thread each. Takes the same arguments as AsyncTfLClient.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.aio = AsyncTfLClient(*args, **kwargs)
+        self.breaker = self.aio.breaker
+        self._loop = None
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._closed:
+                raise TfLError("client closed")
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="tfl-client", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Run a coroutine of `self.aio` on the client's loop and wait for its result."""
+        try:
+            loop = self._get_loop()
+        except TfLError:
+            coro.close()
+            raise
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def live_crowding(self, naptan, timeout=None):
+        return self.run(self.aio.live_crowding(naptan, timeout=timeout))
+
+    def live_crowding_many(self, naptans, timeout=None, delays=None):
+        """
+        Start fetching several stations' payloads, all in one gather on the
+        loop, and return a Future per station without waiting. `delays`
+        (seconds, per station) hold fetches back, e.g. until a rate limit
+        token is due.
+        """
+
+        futures = [Future() for _ in naptans]
+
+        async def fetch(naptan, delay, future):
+            try:
+                if delay:
+                    await asyncio.sleep(delay)
+                future.set_result(await self.aio.live_crowding(naptan, timeout=timeout))
+            except Exception as e:
+                future.set_exception(e)
+
+        async def fetch_all():
+            await asyncio.gather(*(fetch(n, d, f) for n, d, f in zip(naptans, delays or [0] * len(naptans), futures)))
+
+        try:
+            loop = self._get_loop()
+        except TfLError as e:
+            for future in futures:
+                future.set_exception(e)
+            return futures
+        asyncio.run_coroutine_threadsafe(fetch_all(), loop)
+        return futures
+
+    def search(self, name, modes="tube", timeout=None):
+        return self.run(self.aio.search(name, modes=modes, timeout=timeout))
+
+    def stop_points(self, mode="tube", timeout=None, **params):
+        return self.run(self.aio.stop_points(mode, timeout=timeout, **params))
+
+    def close(self):
+        """Close the connections and stop the loop; later calls raise TfLError."""
+        with self._lock:
+            self._closed = True
+            loop, self._loop = self._loop, None
+            thread, self._thread = self._thread, None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.aio.close(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=5)
+            if not loop.is_running():
+                loop.close()
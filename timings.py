@@ -0,0 +1,54 @@
+import time
+
+from contextlib import contextmanager, nullcontext
+
+class Timings:
+    """
+    Wall time spent in the named stages of one request, for the Server-Timing
+    header and the request log. Repeated stages add up; `note` attaches a
+    short description (e.g. cache hit or miss) to a stage.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.notes = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+    def note(self, name, desc):
+        self.notes[name] = desc
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """Server-Timing value: every stage, then the total, in milliseconds."""
+
+        parts = []
+        for name in list(self.stages) + [n for n in self.notes if n not in self.stages]:
+            part = name
+            if name in self.stages:
+                part += f";dur={self.stages[name] * 1e3:.1f}"
+            if name in self.notes:
+                part += f';desc="{self.notes[name]}"'
+            parts.append(part)
+        parts.append(f"total;dur={self.total() * 1e3:.1f}")
+        return ", ".join(parts)
+
+    def as_dict(self):
+        return {
+            "total_ms": round(self.total() * 1e3, 2),
+            "stages_ms": {name: round(t * 1e3, 2) for name, t in self.stages.items()},
+            "notes": dict(self.notes),
+        }
+
+def stage(timings, name):
+    """`timings.stage(name)`, or nothing when there is no Timings."""
+    return timings.stage(name) if timings is not None else nullcontext()